@@ -0,0 +1,472 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Run the salt-cluster.py phases (create, start, configure,
+stop, delete) against stand-ins for the docker daemon and
+for puppet as a service, at several cluster sizes, and
+report how long each phase took and how many calls it made.
+The fake docker daemon listens on a local unix socket and
+the fake pupaas server on a local port; each fake container
+gets its own 127.x.y.z address so they all reach the same
+fake pupaas. Images are not built, only containers are
+managed.
+"""
+
+import os
+import sys
+import imp
+import json
+import time
+import getopt
+import socket
+import shutil
+import tempfile
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+
+SIZES = [10, 100, 1000, 5000]
+MINION_TAG = "trusty:2014.1.10+ds-1_all:deb"
+FINGERPRINT = "01:23:45:67:89:ab:cd:ef:01:23:45:67:89:ab:cd:ef"
+
+
+def load_salt_cluster():
+    'load salt-cluster.py from next to this script as a module'
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "salt-cluster.py")
+    return imp.load_source('salt_cluster', path)
+
+
+class FakeDocker(object):
+    """
+    the containers known to the fake docker daemon, and
+    the calls made to it, grouped into kinds of call by
+    salt-cluster.py itself so they match its --profile
+    report; every request waits 'latency' seconds before
+    it is answered
+    """
+    def __init__(self, salt_cluster, hosts_dir, latency=0):
+        self.salt_cluster = salt_cluster
+        self.hosts_dir = hosts_dir
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.names = {}
+        self.next_id = 1
+        self.next_ip = 2
+        self.calls = collections.Counter()
+
+    def reset_calls(self):
+        'forget the calls made so far, returning them'
+        with self.lock:
+            calls = self.calls
+            self.calls = collections.Counter()
+        return calls
+
+    def find(self, name):
+        'return the container with the given name or id (prefix), or None'
+        if name in self.names:
+            return self.containers[self.names[name]]
+        if name in self.containers:
+            return self.containers[name]
+        for container_id in self.containers:
+            if container_id.startswith(name):
+                return self.containers[container_id]
+        return None
+
+    def get_ip(self):
+        'hand out the next unused loopback address'
+        while True:
+            number = self.next_ip
+            self.next_ip += 1
+            if number & 0xff not in (0, 255):
+                return "127.%d.%d.%d" % ((number >> 16) & 0xff,
+                                         (number >> 8) & 0xff, number & 0xff)
+
+    def handle(self, method, path, body):
+        'answer a request, returning the status and the reply (json or None)'
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method + " " +
+                       self.salt_cluster.get_call_type(path)] += 1
+            parts = path.split('?')[0].strip('/').split('/')
+            if parts[0] == 'containers':
+                return self.handle_container(method, path, parts, body)
+            if parts[0] == 'images':
+                if method == 'GET' and parts[1:] == ['json']:
+                    return 200, []
+                return 404, None
+            return 404, None
+
+    def handle_container(self, method, path, parts, body):
+        'answer a request about containers'
+        if method == 'GET' and parts[1:] == ['json']:
+            return 200, [{'Id': entry['Id'], 'Names': ['/' + entry['Name']],
+                          'Status': 'Up 1 second' if entry['Running']
+                                    else 'Exited (0) 1 second ago'}
+                         for entry in self.containers.values()]
+        if method == 'POST' and parts[1:] == ['create']:
+            name = path.split('name=')[1].split('&')[0]
+            if name in self.names:
+                return 409, None
+            container_id = "%064x" % self.next_id
+            self.next_id += 1
+            hosts_path = os.path.join(self.hosts_dir, container_id)
+            with open(hosts_path, 'w') as hosts:
+                hosts.write("127.0.0.1   localhost\n")
+            config = json.loads(body)
+            self.containers[container_id] = {
+                'Id': container_id, 'Name': name, 'Running': False, 'IP': '',
+                'StartedAt': None, 'HostsPath': hosts_path,
+                'HostConfig': config.get('HostConfig') or {}}
+            self.names[name] = container_id
+            return 201, {'Id': container_id, 'Warnings': None}
+        entry = self.find(parts[1]) if len(parts) > 1 else None
+        if entry is None:
+            return 404, None
+        if method == 'GET' and parts[2:] == ['json']:
+            return 200, {
+                'Id': entry['Id'], 'Name': '/' + entry['Name'],
+                'Config': {'Hostname': entry['Id'][:12]},
+                'State': {'Running': entry['Running'],
+                          'StartedAt': entry['StartedAt']},
+                'NetworkSettings': {'IPAddress': entry['IP']},
+                'HostsPath': entry['HostsPath'],
+                'HostConfig': entry['HostConfig']}
+        if method == 'POST' and parts[2:] == ['start']:
+            # docker hands out a new address on every start
+            entry['Running'] = True
+            entry['StartedAt'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                               time.gmtime())
+            entry['IP'] = self.get_ip()
+            return 204, None
+        if method == 'POST' and parts[2:] == ['stop']:
+            entry['Running'] = False
+            entry['IP'] = ''
+            return 204, None
+        if method == 'DELETE' and len(parts) == 2:
+            del self.names[entry['Name']]
+            del self.containers[entry['Id']]
+            os.unlink(entry['HostsPath'])
+            return 204, None
+        return 404, None
+
+
+class FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    'keep-alive http handler passing requests to the FakeDocker'
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        'read the body if any, answer the request'
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        status, reply = self.server.docker.handle(self.command, self.path,
+                                                  body)
+        contents = json.dumps(reply) if reply is not None else ""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def address_string(self):
+        return "docker.sock"
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    'threaded http server on a unix socket'
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, socket_name, handler, docker):
+        SocketServer.UnixStreamServer.__init__(self, socket_name, handler)
+        self.docker = docker
+
+
+class FakePupaas(object):
+    """
+    the calls made to the fake pupaas server, in all and
+    to each container address; applying a manifest waits
+    'apply_latency' seconds, the way puppet would take
+    its time
+    """
+    def __init__(self, apply_latency=0):
+        self.apply_latency = apply_latency
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.calls_by_address = collections.defaultdict(collections.Counter)
+
+    def reset_calls(self):
+        'forget the calls made so far, returning them'
+        with self.lock:
+            calls = self.calls
+            self.calls = collections.Counter()
+            self.calls_by_address.clear()
+        return calls
+
+    def handle(self, method, path, address=None):
+        """
+        answer a request made to the given container address,
+        returning the status and the reply
+        """
+        parts = path.strip('/').split('/')
+        with self.lock:
+            self.calls["%s /%s" % (method, parts[0])] += 1
+            self.calls_by_address[address]["%s /%s" % (method, parts[0])] += 1
+        if parts[0] == 'manifest' and method in ('PUT', 'DELETE'):
+            return 200, ""
+        if parts[0] == 'apply' and method == 'POST':
+            if self.apply_latency:
+                time.sleep(self.apply_latency)
+            return 200, ""
+        if parts[0] == 'fact' and method == 'GET':
+            if parts[1:] == ['salt_key_fingerprint']:
+                return 200, FINGERPRINT + "\n"
+            return 200, "\n"
+        return 404, "not found"
+
+
+class FakePupaasHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    'keep-alive http handler passing requests to the FakePupaas'
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        'read the body if any, answer the request'
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        # every container address reaches this server, so the
+        # address the request came in on says which one it was for
+        status, contents = self.server.pupaas.handle(
+            self.command, self.path, self.connection.getsockname()[0])
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+class TCPHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    'threaded http server on all addresses, so every 127.x.y.z reaches it'
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, handler, pupaas):
+        BaseHTTPServer.HTTPServer.__init__(self, ('0.0.0.0', 0), handler)
+        self.pupaas = pupaas
+
+
+def start_server(server):
+    'serve requests in a background thread'
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    return thr
+
+
+def start_master_port():
+    """
+    listen on a free port standing in for the salt master
+    port, accepting and closing connections; return the port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', 0))
+    sock.listen(1024)
+
+    def accept():
+        'accept and drop connections forever'
+        while True:
+            conn, _ = sock.accept()
+            conn.close()
+    thr = threading.Thread(target=accept)
+    thr.daemon = True
+    thr.start()
+    return sock.getsockname()[1]
+
+
+def run_size(salt_cluster, size, jobs, work_dir, docker, pupaas,
+             pupaas_port, verbose):
+    """
+    create, start, configure, stop and delete a cluster of
+    'size' minions, returning the results for each phase
+    """
+    state_dir = os.path.join(work_dir, "state-%d" % size)
+    cluster = salt_cluster.SaltCluster(
+        'master', 'minion', pupaas_port, '/usr/bin/docker',
+        "%d:%s" % (size, MINION_TAG), MINION_TAG, True, False, verbose,
+        jobs, state_dir=state_dir, retries=0)
+    # no images here, the fake daemon only does containers
+    cluster.add_image_build = lambda graph, tag, role: None
+
+    results = []
+    for phase in ['create', 'start', 'configure', 'stop', 'delete']:
+        docker.reset_calls()
+        pupaas.reset_calls()
+        start = time.time()
+        failures = getattr(cluster, phase + '_cluster')()
+        elapsed = time.time() - start
+        docker_calls = docker.reset_calls()
+        pupaas_calls = pupaas.reset_calls()
+        results.append({
+            'minions': size, 'phase': phase, 'seconds': elapsed,
+            'minions_per_second': size / elapsed if elapsed else None,
+            'failures': len(failures or []),
+            'docker_calls': sum(docker_calls.values()),
+            'pupaas_calls': sum(pupaas_calls.values()),
+            'docker_calls_by_type': dict(docker_calls),
+            'pupaas_calls_by_type': dict(pupaas_calls)})
+        if verbose:
+            sys.stderr.write("%d minions: %s done in %.3fs\n" %
+                             (size, phase, elapsed))
+    cluster.backend.puppet.close()
+    return results
+
+
+def show_results(results):
+    'print a table of the results, with calls per minion'
+    print "%8s %-10s %10s %11s %9s %12s %12s" % (
+        "minions", "phase", "seconds", "minions/s", "failures",
+        "docker/min", "pupaas/min")
+    for entry in results:
+        print "%8d %-10s %10.3f %11.1f %9d %12.2f %12.2f" % (
+            entry['minions'], entry['phase'], entry['seconds'],
+            entry['minions_per_second'] or 0, entry['failures'],
+            entry['docker_calls'] / float(entry['minions']),
+            entry['pupaas_calls'] / float(entry['minions']))
+
+
+def usage(message=None):
+    'display a helpful usage message with an optional introductory message'
+    if message:
+        sys.stderr.write(message + "\n")
+    usage_message = """
+Usage: salt-cluster-benchmark.py [--sizes num,num...] [--jobs num]
+                                 [--latency msecs] [--apply-latency msecs]
+                                 [--json path] [--verbose] [--help]
+
+Runs the create, start, configure, stop and delete phases of
+salt-cluster.py against a fake docker daemon (on a unix socket)
+and a fake pupaas server, for clusters of each of the given sizes,
+and reports the time taken, the throughput and the number of calls
+to docker and to pupaas per minion for each phase. Calls per minion
+that grow with the cluster size point at O(N^2) work.
+
+Options:
+
+  --sizes     (-s)  comma separated list of cluster sizes
+                    default: %(sizes)s
+  --jobs      (-j)  number of minions to work on at once, or 'auto'
+                    default: 20
+  --latency   (-l)  milliseconds the fake docker daemon waits before
+                    answering each request
+                    default: 0
+  --apply-latency   milliseconds the fake pupaas server waits before
+                    answering each manifest apply
+                    default: 0
+  --json            also write all the results, including the calls
+                    by type, as json to this file
+  --verbose   (-v)  show progress messages as the benchmark runs
+  --help      (-h)  display this usage message
+""" % {'sizes': ",".join(str(size) for size in SIZES)}
+    sys.stderr.write(usage_message)
+    sys.exit(1)
+
+
+def main():
+    'main entry point, does all the work'
+    sizes = SIZES
+    jobs = 20
+    latency = 0
+    apply_latency = 0
+    json_path = None
+    verbose = False
+
+    try:
+        (options, remainder) = getopt.gnu_getopt(
+            sys.argv[1:], "s:j:l:vh",
+            ["sizes=", "jobs=", "latency=", "apply-latency=", "json=",
+             "verbose", "help"])
+    except getopt.GetoptError as err:
+        usage("Unknown option specified: " + str(err))
+
+    salt_cluster = load_salt_cluster()
+    for (opt, val) in options:
+        if opt in ["-s", "--sizes"]:
+            if not all(size.isdigit() for size in val.split(',')):
+                usage("sizes must be a comma separated list of numbers")
+            sizes = [int(size) for size in val.split(',')]
+        elif opt in ["-j", "--jobs"]:
+            jobs = salt_cluster.get_concurrency_from_text(val)
+            if jobs is None:
+                usage("jobs must be a positive number or 'auto'")
+        elif opt in ["-l", "--latency"]:
+            if not val.isdigit():
+                usage("latency must be a number")
+            latency = int(val) / 1000.0
+        elif opt == "--apply-latency":
+            if not val.isdigit():
+                usage("apply-latency must be a number")
+            apply_latency = int(val) / 1000.0
+        elif opt == "--json":
+            json_path = val
+        elif opt in ["-v", "--verbose"]:
+            verbose = True
+        elif opt in ["-h", "--help"]:
+            usage()
+        else:
+            usage("Unknown option specified: <%s>" % opt)
+
+    if len(remainder) > 0:
+        usage("Unknown option(s) specified: <%s>" % remainder[0])
+
+    work_dir = tempfile.mkdtemp(prefix="salt-cluster-benchmark-")
+    try:
+        hosts_dir = os.path.join(work_dir, "hosts")
+        os.mkdir(hosts_dir)
+        socket_name = os.path.join(work_dir, "docker.sock")
+        docker = FakeDocker(salt_cluster, hosts_dir, latency)
+        docker_server = UnixHTTPServer(socket_name, FakeDockerHandler, docker)
+        start_server(docker_server)
+        pupaas = FakePupaas(apply_latency)
+        pupaas_server = TCPHTTPServer(FakePupaasHandler, pupaas)
+        start_server(pupaas_server)
+
+        salt_cluster.DOCKER_API.socket_name = socket_name
+        salt_cluster.SALT_MASTER_PORT = start_master_port()
+        salt_cluster.set_thread_stack_size()
+
+        results = []
+        for size in sizes:
+            results.extend(run_size(salt_cluster, size, jobs, work_dir,
+                                    docker, pupaas,
+                                    pupaas_server.server_address[1], verbose))
+        # close our keep-alive connections so the servers'
+        # handler threads are done before we exit
+        salt_cluster.DOCKER_API.close()
+        for server in [docker_server, pupaas_server]:
+            server.shutdown()
+            server.server_close()
+        show_results(results)
+        if json_path:
+            with open(json_path, 'w') as json_file:
+                json_file.write(json.dumps(results, indent=1, sort_keys=True)
+                                + "\n")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
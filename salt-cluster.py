@@ -9,6 +9,17 @@ import threading
 import traceback
 import time
 import re
+import os
+import multiprocessing
+import collections
+import tarfile
+import urllib
+import StringIO
+import hashlib
+import random
+import struct
+import select
+import codecs
 
 # script to start a salt master via docker, fix up minion
 # configs and start salt clients via docker, get all the
@@ -17,6 +28,91 @@ import re
 
 VERSION = "0.1.8"
 
+# when picking the number of instances to work on at once
+# ('--jobs auto'), allow this many per idle processor and
+# this much free memory per instance, up to this limit
+JOBS_PER_CPU = 4
+MB_PER_JOB = 64
+MAX_AUTO_JOBS = 64
+
+# images are labelled with a hash of everything that went
+# into them, so we can tell when they need rebuilding
+HASH_LABEL = 'saltcluster.hash'
+
+# salt git versions are looked up here to see if they moved;
+# the commits found are kept in this file in the state dir and
+# looked up again once they are older than this many seconds
+SALT_GIT_REPO = "https://github.com/saltstack/salt.git"
+GIT_COMMITS_FILE = "git-commits.json"
+GIT_COMMIT_MAX_AGE = 3600
+GIT_COMMITS = None
+GIT_COMMITS_LOCK = threading.Lock()
+
+# most image builds to run at once
+MAX_BUILD_JOBS = 4
+
+# the base images are built from here
+SALT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "salt")
+
+# how long to wait for a service in a container to come up,
+# and how long to wait between checks, at first and at most
+READY_TIMEOUT = 60
+READY_INITIAL_DELAY = 0.2
+READY_MAX_DELAY = 5
+
+# config files used when configuring salt without puppet
+SALT_MASTER_CONFIG = os.path.join(SALT_DIR, "puppet-salt", "files",
+                                  "salt-master-config")
+SALT_MINION_CONFIG_TEMPLATE = os.path.join(SALT_DIR, "puppet-salt",
+                                           "templates",
+                                           "salt-minion-config.templ")
+
+# copied to the salt master and run there for --benchmark
+SALT_LOAD_SCRIPT = os.path.join(SALT_DIR, "salt-load.py")
+SALT_EVENTS_SCRIPT = os.path.join(SALT_DIR, "salt-events.py")
+# --telemetry buckets events by this many seconds, and stops
+# after this long if there is nothing else to do meanwhile
+TELEMETRY_BUCKET = 1
+TELEMETRY_DURATION = 60
+BENCHMARK_DEFAULTS = {'function': 'test.ping', 'args': [], 'jobs': 10,
+                      'rate': 1.0, 'concurrency': 1, 'timeout': 30}
+
+# where we keep things between runs, like keys we generate
+STATE_DIR = "/var/lib/salt-cluster"
+MASTER_KEY_SIZE = 4096
+MINION_KEY_SIZE = 2048
+
+# minions return results to the master on this port
+SALT_MASTER_PORT = 4506
+
+# instances that fail in a phase are retried this many times
+# by default, waiting this long (doubled each time) in between
+RETRIES = 2
+RETRY_DELAY = 2
+
+# upper bounds (ms) of the buckets in the --profile call histograms,
+# and how many of the slowest instances and calls to summarize
+PROFILE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000, 30000, 60000]
+PROFILE_TOP = 10
+
+# streamed docker api output (build progress) is read
+# and handed on in pieces of at most this many bytes
+STREAM_READ_SIZE = 256
+
+# stack size for worker threads
+WORKER_STACK_SIZE = 512 * 1024
+
+# the cluster dns resolver gives out answers good for this
+# many seconds and rechecks container ips this often
+DNS_TTL = 5
+DNS_PORT = 53
+# queries it passes on to the host's nameserver are handled
+# by this many threads, with at most this many waiting;
+# more than that are dropped and the client will ask again
+DNS_FORWARDERS = 8
+DNS_FORWARD_QUEUE = 256
+
 class DockerError(Exception):
     """
     placeholder for some sort of interesting
@@ -25,6 +121,129 @@ class DockerError(Exception):
     pass
 
 
+class NotReadyError(Exception):
+    """
+    something we waited for (a service listening,
+    a key being generated) didn't happen in time
+    """
+    pass
+
+
+class Profiler(object):
+    """
+    timings for --profile: latencies of each type of call
+    (docker api requests, pupaas requests, hosts file writes,
+    builds), the wall time of each cluster phase, and the
+    wall time spent on each instance in each phase; nothing
+    is recorded unless enabled
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.phases = []
+        self.instances = []
+
+    def record_call(self, call_type, seconds):
+        'add the latency of one call of the given type'
+        with self.lock:
+            self.calls.setdefault(call_type, []).append(seconds)
+
+    def record_phase(self, phase, seconds):
+        'add the wall time of a cluster phase'
+        with self.lock:
+            self.phases.append({'phase': phase, 'seconds': seconds})
+
+    def record_instance(self, phase, instance, seconds):
+        'add the wall time spent on an instance during a phase'
+        with self.lock:
+            self.instances.append({'phase': phase, 'instance': instance,
+                                   'seconds': seconds})
+
+    def timed(self, call_type, phase=False):
+        """
+        decorator that records the time each call to the
+        function takes, as a call of the given type or,
+        if phase is set, as a cluster phase
+        """
+        def decorate(function):
+            'wrap the function'
+            def timed_function(*args, **kwargs):
+                'call the function, timing it if profiling'
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    if phase:
+                        self.record_phase(call_type, time.time() - start)
+                    else:
+                        self.record_call(call_type, time.time() - start)
+            timed_function.__name__ = function.__name__
+            timed_function.__doc__ = function.__doc__
+            return timed_function
+        return decorate
+
+    def get_report(self):
+        """
+        return the timings as a dict: per call type the count,
+        total, percentiles and a histogram of latencies, the
+        phases, and the slowest instances
+        """
+        with self.lock:
+            calls = dict((call_type, sorted(times))
+                         for call_type, times in self.calls.items())
+            phases = list(self.phases)
+            instances = sorted(self.instances,
+                               key=lambda entry: -entry['seconds'])
+        call_stats = {}
+        for call_type, times in calls.items():
+            histogram = [0] * (len(PROFILE_BUCKETS) + 1)
+            for seconds in times:
+                bucket = 0
+                while (bucket < len(PROFILE_BUCKETS) and
+                       seconds * 1000 > PROFILE_BUCKETS[bucket]):
+                    bucket += 1
+                histogram[bucket] += 1
+            call_stats[call_type] = {
+                'count': len(times), 'total': sum(times),
+                'mean': sum(times) / len(times),
+                'p50': get_percentile(times, 50),
+                'p95': get_percentile(times, 95),
+                'p99': get_percentile(times, 99),
+                'max': times[-1],
+                'histogram_ms': dict(zip(
+                    [str(bound) for bound in PROFILE_BUCKETS] + ['more'],
+                    histogram))}
+        return {'calls': call_stats, 'phases': phases,
+                'slowest_instances': instances[:PROFILE_TOP],
+                'instances': len(instances)}
+
+    def get_summary(self, report):
+        'return a human readable summary of the report'
+        lines = ["Phases:"]
+        for entry in report['phases']:
+            lines.append("  %-24s %10.3fs" % (entry['phase'], entry['seconds']))
+        lines.append("Slowest call types (by total time):")
+        lines.append("  %-36s %7s %10s %9s %9s %9s" % (
+            "call", "count", "total", "p50", "p95", "max"))
+        by_total = sorted(report['calls'].items(),
+                          key=lambda item: -item[1]['total'])
+        for call_type, stats in by_total[:PROFILE_TOP]:
+            lines.append("  %-36s %7d %9.3fs %8.3fs %8.3fs %8.3fs" % (
+                call_type, stats['count'], stats['total'], stats['p50'],
+                stats['p95'], stats['max']))
+        lines.append("Slowest instances:")
+        for entry in report['slowest_instances']:
+            lines.append("  %-40s %-12s %9.3fs" % (
+                entry['instance'], entry['phase'], entry['seconds']))
+        return "\n".join(lines) + "\n"
+
+
+PROFILER = Profiler()
+
+
 class LocalHTTPConnection(httplib.HTTPConnection):
     """
     our own httpconnection class with
@@ -43,13 +262,573 @@ class LocalHTTPConnection(httplib.HTTPConnection):
         sock.settimeout(None)
         self.sock = sock
 
+
+class ConnectionPool(object):
+    """
+    keep http/1.1 connections to one server alive and
+    hand them out from a pool, so that threads can share
+    them instead of opening a new connection for every
+    request; connection_factory is called with no
+    arguments to make a new (not yet connected) one
+    """
+    def __init__(self, connection_factory, max_idle=10):
+        self.connection_factory = connection_factory
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        'return a new (not yet connected) http connection'
+        return self.connection_factory()
+
+    def get_connection(self):
+        """
+        return an idle connection from the pool if there
+        is one, or a new one, along with a flag saying
+        whether it was reused
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                http_conn = self.idle.pop()
+            if not is_connection_dropped(http_conn):
+                return http_conn, True
+            http_conn.close()
+        return self.new_connection(), False
+
+    def release_connection(self, http_conn):
+        """
+        put a connection back into the pool, or close
+        it if the pool already has enough idle ones
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(http_conn)
+                return
+        http_conn.close()
+
+    def close(self):
+        'close all idle connections'
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for http_conn in idle:
+            http_conn.close()
+
+    def request(self, url, method='GET', content=None, headers=None):
+        """
+        send a request and return the response status
+        and body; idle connections that the server has
+        closed are thrown away before use, and if a reused
+        connection fails anyway, GET and HEAD requests are
+        retried on a fresh one (others may already have
+        been acted on, so doing them again is not safe)
+        """
+        while True:
+            http_conn, reused = self.get_connection()
+            try:
+                http_conn.request(method, url, body=content,
+                                  headers=headers or {})
+                response = http_conn.getresponse(buffering=True)
+                data = response.read()
+            except (socket.error, httplib.HTTPException):
+                http_conn.close()
+                if reused and method in ['GET', 'HEAD']:
+                    continue
+                raise
+            if response.will_close:
+                http_conn.close()
+            else:
+                self.release_connection(http_conn)
+            return response.status, data
+
+
+class DockerClient(ConnectionPool):
+    """
+    talk to the docker api over the local socket,
+    reusing pooled keep-alive connections
+    """
+    def __init__(self, socket_name="/var/run/docker.sock",
+                 timeout=20, max_idle=10):
+        super(DockerClient, self).__init__(self.make_connection, max_idle)
+        self.socket_name = socket_name
+        self.timeout = timeout
+
+    def make_connection(self):
+        'make a new connection to the docker socket'
+        try:
+            return LocalHTTPConnection(self.socket_name, timeout=self.timeout)
+        except Exception:
+            print "failed to establish http connection to localhost for docker"
+            raise
+
+    def request(self, url, method='GET', content=None,
+                content_type="application/json"):
+        'send a request to the docker api, return status and body'
+        hdr = {"User-Agent": "test-docker-api.py"}
+        if content:
+            hdr["Content-Type"] = content_type
+        if not PROFILER.enabled:
+            return super(DockerClient, self).request(url, method, content,
+                                                     hdr)
+        start = time.time()
+        try:
+            return super(DockerClient, self).request(url, method, content,
+                                                     hdr)
+        finally:
+            PROFILER.record_call("docker %s %s" % (method, get_call_type(url)),
+                                 time.time() - start)
+
+    def stream_json(self, url, method='GET', content=None,
+                    content_type="application/json"):
+        """
+        send a request to the docker api and yield each of the
+        json messages making up the (streamed) response as soon
+        as it arrives; this gets a connection to itself, since
+        it may be busy for a long time
+        """
+        http_conn = self.new_connection()
+        try:
+            hdr = {"User-Agent": "test-docker-api.py"}
+            if content:
+                hdr["Content-Type"] = content_type
+            http_conn.request(method, url, body=content, headers=hdr)
+            response = http_conn.getresponse()
+            if response.status != 200:
+                data = response.read()
+                if data:
+                    sys.stderr.write(data + "\n")
+                raise IOError('failed to get url ' + url,
+                              " with response code " + str(response.status))
+            for message in read_json_messages(read_chunks(response)):
+                yield message
+        finally:
+            http_conn.close()
+
+    def get_url(self, url, method='GET', content=None):
+        """
+        retrieve a specified docker api url, returning
+        the decoded json response if there is one
+        """
+        status, data = self.request(url, method, content)
+        if status == 200 or status == 201 or status == 204:
+            if data:
+                return json.loads(data.decode('utf-8'))
+            else:
+                return ""
+        else:
+            if data:
+                sys.stderr.write(data + "\n")
+            raise IOError('failed to get url ' + url,
+                          " with response code " + str(status))
+
+
+class ContainerInventory(object):
+    """
+    snapshot of all containers on the host, taken with
+    a single listing and indexed by name and id, so that
+    existence and running checks for many containers
+    don't each rescan the full container list;
+    call invalidate() at the start of a phase to have
+    the next check take a fresh listing, or pass it
+    the containers the phase is about, so that only a
+    check on one of those takes a fresh listing and
+    others using the snapshot meanwhile aren't disturbed
+    """
+    def __init__(self, docker_api):
+        self.docker_api = docker_api
+        self.by_name = None
+        self.by_id = {}
+        self.stale = set()
+        self.lock = threading.Lock()
+
+    def invalidate(self, container_names=None):
+        """
+        throw away the snapshot, or mark the specified
+        containers as out of date in it; the next lookup
+        (of one of them) will refresh it
+        """
+        with self.lock:
+            if container_names is None:
+                self.by_name = None
+                self.by_id = {}
+            elif self.by_name is not None:
+                self.stale.update(container_names)
+
+    def check_fresh(self, container_name=None):
+        """
+        refresh the snapshot if it was thrown away, or if
+        the specified container is out of date in it
+        """
+        with self.lock:
+            fresh = (self.by_name is not None and
+                     container_name not in self.stale)
+        if not fresh:
+            self.refresh()
+
+    def refresh(self):
+        """
+        list all containers via the docker api and
+        index them by name and id
+        """
+        output = self.docker_api.get_url("/containers/json?all=1")
+        by_name = {}
+        by_id = {}
+        for entry in output:
+            info = {'id': entry['Id'],
+                    'running': entry['Status'].startswith('Up'),
+                    'names': [n[1:] for n in (entry['Names'] or [])]}
+            by_id[info['id']] = info
+            for name in info['names']:
+                by_name[name] = info
+        with self.lock:
+            self.by_name = by_name
+            self.by_id = by_id
+            self.stale = set()
+
+    def lookup(self, container_name):
+        """
+        return the inventory entry for the container with
+        the specified name or id (prefix), or None
+        """
+        while True:
+            self.check_fresh(container_name)
+            with self.lock:
+                if self.by_name is None:
+                    # invalidated by another thread meanwhile
+                    continue
+                if container_name in self.by_name:
+                    return self.by_name[container_name]
+                if container_name in self.by_id:
+                    return self.by_id[container_name]
+                if is_hex_digits(container_name):
+                    for container_id in self.by_id:
+                        if container_id.startswith(container_name):
+                            return self.by_id[container_id]
+                return None
+
+    def lookup_host(self, host_name):
+        """
+        return the inventory entry for the container with
+        exactly the specified name, or with the specified
+        hostname (the first 12 digits of its id), or None;
+        unlike lookup, no other id prefixes are matched
+        """
+        while True:
+            self.check_fresh(host_name)
+            with self.lock:
+                if self.by_name is None:
+                    continue
+                if host_name in self.by_name:
+                    return self.by_name[host_name]
+                if len(host_name) == 12 and is_hex_digits(host_name):
+                    for container_id in self.by_id:
+                        if container_id[:12] == host_name:
+                            return self.by_id[container_id]
+                return None
+
+    def names(self):
+        'return the names of all containers'
+        while True:
+            self.check_fresh()
+            with self.lock:
+                if self.by_name is not None:
+                    return self.by_name.keys()
+
+    def exists(self, container_name):
+        'check if the specified container exists'
+        return self.lookup(container_name) is not None
+
+    def is_running(self, container_name):
+        'check if the specified container is running'
+        info = self.lookup(container_name)
+        return info is not None and info['running']
+
+    def add(self, container_name, container_id):
+        'record a container we just created'
+        with self.lock:
+            if self.by_name is None:
+                return
+            info = {'id': container_id, 'running': False,
+                    'names': [container_name]}
+            self.by_id[container_id] = info
+            self.by_name[container_name] = info
+
+    def set_running(self, container_name, running):
+        'record that we started or stopped a container'
+        info = self.lookup(container_name)
+        if info is None:
+            return
+        with self.lock:
+            # another thread may have thrown the snapshot away
+            # since, then the next lookup will find out anyway
+            if self.by_name is not None:
+                info['running'] = running
+
+    def remove(self, container_name):
+        'record that we deleted a container'
+        info = self.lookup(container_name)
+        if info is None:
+            return
+        with self.lock:
+            if self.by_name is None:
+                return
+            self.by_id.pop(info['id'], None)
+            for name in info['names']:
+                self.by_name.pop(name, None)
+
+
+class ImageCatalog(object):
+    """
+    the list of images on the host, fetched once and
+    indexed by image name (repo:tag) and by id, shared
+    by everything that needs to know whether an image
+    exists or what its id is; call invalidate() after
+    building or deleting an image
+    """
+    def __init__(self, docker_api):
+        self.docker_api = docker_api
+        self.by_name = None
+        self.ids = []
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        'throw away the image list, the next lookup will refresh it'
+        with self.lock:
+            self.by_name = None
+            self.ids = []
+            self.labels = {}
+
+    def refresh(self):
+        """
+        list all images via the docker api and index
+        them by name and id
+        """
+        output = self.docker_api.get_url("/images/json")
+        by_name = {}
+        ids = []
+        for entry in output:
+            ids.append(entry['Id'])
+            for repo_tag in (entry['RepoTags'] or []):
+                by_name[repo_tag] = entry['Id']
+        with self.lock:
+            self.by_name = by_name
+            self.ids = ids
+
+    def get_id(self, image_name):
+        """
+        return the id of the image with the specified
+        name or id (prefix), or None if there is none
+        """
+        while True:
+            if self.by_name is None:
+                self.refresh()
+            with self.lock:
+                if self.by_name is None:
+                    # invalidated by another thread meanwhile
+                    continue
+                if image_name in self.by_name:
+                    return self.by_name[image_name]
+                for image_id in self.ids:
+                    if (image_id.startswith(image_name) or
+                            image_id.startswith("sha256:" + image_name)):
+                        return image_id
+                return None
+
+    def get_labels(self, image_name):
+        """
+        return the labels of the specified image,
+        inspecting it the first time we are asked
+        """
+        with self.lock:
+            if image_name in self.labels:
+                return self.labels[image_name]
+        output = self.docker_api.get_url("/images/" + image_name + "/json")
+        labels = (output.get('Config') or {}).get('Labels') or {}
+        with self.lock:
+            self.labels[image_name] = labels
+        return labels
+
+    def remove(self, image_id):
+        'record that we deleted an image'
+        with self.lock:
+            if self.by_name is None:
+                return
+            self.ids = [entry for entry in self.ids if entry != image_id]
+            for name in [name for name in self.by_name
+                         if self.by_name[name] == image_id]:
+                del self.by_name[name]
+
+
+class ContainerMetadata(object):
+    """
+    cache of container inspect results, so that each
+    container is inspected at most once per phase no
+    matter how many times we need its ip address or
+    hosts file; call invalidate() at the start of a phase
+    """
+    def __init__(self, docker_api):
+        self.docker_api = docker_api
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self, container_name=None):
+        """
+        forget what we know about the specified container,
+        or about all containers if none is specified
+        """
+        with self.lock:
+            if container_name is None:
+                self.entries = {}
+            else:
+                self.entries.pop(container_name, None)
+
+    def inspect(self, container_name):
+        """
+        inspect the specified container via the docker api
+        and save the bits we care about
+        """
+        output = self.docker_api.get_url(
+            "/containers/" + container_name + "/json")
+        entry = {'id': output['Id'],
+                 'hostname': output['Config']['Hostname'],
+                 'running': output['State']['Running'],
+                 'started': output['State'].get('StartedAt'),
+                 'ip': output['NetworkSettings']['IPAddress'].strip(),
+                 'hosts_path': output['HostsPath'].strip(),
+                 'shared_hosts': get_hosts_bind(output),
+                 'dns': (output.get('HostConfig') or {}).get('Dns') or []}
+        with self.lock:
+            self.entries[container_name] = entry
+        return entry
+
+    def get(self, container_name):
+        'return the (possibly cached) metadata for the specified container'
+        with self.lock:
+            if container_name in self.entries:
+                return self.entries[container_name]
+        return self.inspect(container_name)
+
+    def prefetch(self, container_names, num_threads=20):
+        """
+        inspect all of the specified containers that are
+        not already cached, several at a time; failures
+        are ignored here, they will be raised again when
+        the caller asks for the container in question
+        """
+        with self.lock:
+            todo = [name for name in container_names
+                    if name not in self.entries]
+        run_jobs(todo, self.inspect, num_threads)
+
+
+class ClusterState(object):
+    """
+    what we know about a cluster between runs, kept as json
+    in the state directory: the minion tags and prefix it was
+    made with, the master (id, ip, key fingerprint), each
+    minion (instance number, id, ip, and the last phase that
+    was done for it, or the error from the last one that
+    failed) and the image ids; call save() after each phase
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'master': {}, 'minions': {}, 'images': {}}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as state_file:
+                    self.data.update(json.load(state_file))
+            except (IOError, ValueError) as err:
+                # a half written or mangled file only costs us
+                # finding things out again, as if there were none
+                sys.stderr.write("ignoring unreadable cluster state in "
+                                 "%s (%s)\n" % (path, err))
+
+    def get(self, key, default=None):
+        'return the value for a top level setting'
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        'change a top level setting'
+        with self.lock:
+            self.data[key] = value
+
+    def get_instance(self, name):
+        'return a copy of the saved entry for the minion, empty if none'
+        with self.lock:
+            return dict(self.data['minions'].get(name, {}))
+
+    def update_instance(self, name, **fields):
+        'update the saved entry for the minion with the given fields'
+        with self.lock:
+            self.data['minions'].setdefault(name, {}).update(fields)
+
+    def remove_instance(self, name):
+        'forget the minion'
+        with self.lock:
+            self.data['minions'].pop(name, None)
+
+    def update_master(self, **fields):
+        'update the saved entry for the master with the given fields'
+        with self.lock:
+            self.data['master'].update(fields)
+
+    def sync(self):
+        """
+        drop saved minions whose containers are gone or
+        were recreated, checked against the inventory
+        """
+        with self.lock:
+            names = self.data['minions'].keys()
+        for name in names:
+            info = INVENTORY.lookup(name)
+            with self.lock:
+                entry = self.data['minions'].get(name)
+                if entry is None:
+                    continue
+                if info is None or info['id'] != entry.get('id', info['id']):
+                    del self.data['minions'][name]
+
+    def save(self):
+        """
+        write the state out, replacing the old file in one go;
+        not being able to is worth a warning but no more, the
+        next run will just have to find things out again
+        """
+        with self.lock:
+            contents = json.dumps(self.data, indent=1, sort_keys=True)
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0700)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as state_file:
+                state_file.write(contents)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as err:
+            sys.stderr.write("failed to save cluster state to %s (%s)\n" %
+                             (self.path, err))
+
+
+DOCKER_API = DockerClient()
+INVENTORY = ContainerInventory(DOCKER_API)
+IMAGES = ImageCatalog(DOCKER_API)
+METADATA = ContainerMetadata(DOCKER_API)
+
+
 class Docker(object):
     """
     build or run a docker image
     """
-    def __init__(self, docker):
+    def __init__(self, docker, verbose=False):
         self.docker = docker
+        self.verbose = verbose
 
+    @PROFILER.timed('docker build')
     def build(self, dockerfile_contents, image_repo, image_tag):
         """
         build an image from the specified docker
@@ -57,34 +836,119 @@ class Docker(object):
         from the image repo name and the
         os and salt version info in the image tag
         """
-        # we only keep the last layer so that we can purge easily
-        command = [self.docker, 'build', '--rm', '-t',
-                   get_image_name(image_repo, image_tag), '-']
-        stdoutdata = None
-        stderrdata = None
         try:
-            proc = subprocess.Popen(command, stdin=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
+            self.build_image(get_image_name(image_repo, image_tag),
+                             dockerfile_contents)
+        finally:
+            IMAGES.invalidate()
+
+    @PROFILER.timed('docker build_base')
+    def build_base(self, image_repo, distro):
+        """
+        build the base image for the specified distro from
+        the dockerfile generate_dockerfile.py writes for it,
+        with the salt directory as the build context
+        """
+        image_name = get_base_image_name(image_repo, distro)
+        try:
+            proc = subprocess.Popen([sys.executable, "generate_dockerfile.py",
+                                     "-d", distro], cwd=SALT_DIR,
                                     stdout=subprocess.PIPE)
-            stdoutdata, stderrdata = proc.communicate(dockerfile_contents)
+            dockerfile_contents, _ = proc.communicate()
             if proc.returncode:
-                if stderrdata:
-                    sys.stderr.write(stderrdata)
-                if stdoutdata:
-                    sys.stderr.write(stdoutdata)
-                raise DockerError("Error building docker image %s (%s)\n"
-                                  % (get_image_name(image_repo, image_tag),
-                                     stderrdata))
+                raise DockerError("Error generating dockerfile for %s\n"
+                                  % image_name)
+            self.build_image(image_name, dockerfile_contents, SALT_DIR)
+        finally:
+            IMAGES.invalidate()
+
+    def build_image(self, image_name, dockerfile_contents, context_dir=None):
+        """
+        build an image with the specified name from the
+        dockerfile contents plus the files in context_dir,
+        if any, via the docker api; if we can't talk to
+        the api, fall back to running the docker command
+        """
+        try:
+            self.build_via_api(image_name, dockerfile_contents, context_dir)
+            return
+        except DockerError:
+            sys.stderr.write('Failed to build docker image ' +
+                             image_name + "\n")
+            raise
+        except IOError as ex:
+            sys.stderr.write("Failed to build %s via the docker api (%s), "
+                             "trying %s\n" % (image_name, ex, self.docker))
+        try:
+            self.build_via_command(image_name, dockerfile_contents,
+                                   context_dir)
         except Exception:
             sys.stderr.write('Failed to build docker image ' +
-                             get_image_name(image_repo, image_tag) + "\n")
+                             image_name + "\n")
             raise
 
+    def build_via_api(self, image_name, dockerfile_contents, context_dir=None):
+        """
+        send a tar build context made in memory (the dockerfile
+        plus the files in context_dir) to the docker api,
+        showing the build progress as it streams back
+        """
+        context = make_build_context(dockerfile_contents, context_dir)
+        # we only keep the last layer so that we can purge easily
+        url = "/build?rm=1&t=" + urllib.quote(image_name)
+        # only the tail of the output is kept, for error reports
+        output = collections.deque(maxlen=20)
+        for message in DOCKER_API.stream_json(url, 'POST', context,
+                                              "application/x-tar"):
+            if 'error' in message:
+                for line in output:
+                    sys.stderr.write(line + "\n")
+                raise DockerError("Error building docker image %s (%s)\n"
+                                  % (image_name, message['error'].strip()))
+            line = message.get('stream', message.get('status', '')).rstrip()
+            if line:
+                output.append(line)
+                display(self.verbose, image_name + ": " + line)
+
+    def build_via_command(self, image_name, dockerfile_contents,
+                          context_dir=None):
+        """
+        build the image by running the docker command, feeding
+        it the dockerfile over stdin if there is no context_dir
+        """
+        # we only keep the last layer so that we can purge easily
+        command = [self.docker, 'build', '--rm', '-t', image_name]
+        if context_dir:
+            dockerfile_path = os.path.join(
+                context_dir, "Dockerfile." + sanitize(image_name))
+            with open(dockerfile_path, 'w') as dockerfile:
+                dockerfile.write(dockerfile_contents)
+            command.extend(['-f', dockerfile_path, context_dir])
+            dockerfile_contents = None
+        else:
+            command.append('-')
+        stdoutdata = None
+        stderrdata = None
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        stdoutdata, stderrdata = proc.communicate(dockerfile_contents)
+        if proc.returncode:
+            if stderrdata:
+                sys.stderr.write(stderrdata)
+            if stdoutdata:
+                sys.stderr.write(stdoutdata)
+            raise DockerError("Error building docker image %s (%s)\n"
+                              % (image_name, stderrdata))
+
     # docker run -i -t -v imagename
-    def create(self, image_name, container_name=None):
+    def create(self, image_name, container_name=None, binds=None,
+               dns=None):
         """
         create a container based on a specified image;
         this is the equivalent of the docker-run command
+        binds is an optional list of 'hostpath:containerpath'
+        bind mounts, dns an optional list of nameserver ips
         """
         config = {
             "Hostname":"", "Domainname":"", "User":"",
@@ -97,7 +961,8 @@ class Docker(object):
             "HostConfig":
             {
                 "Memory":0, "MemorySwap":0,
-                "CpuShares":0, "Dns":None, "VolumesFrom":None
+                "CpuShares":0, "Dns":dns, "VolumesFrom":None,
+                "Binds":binds
             },
             "NetworkDisabled":False
         }
@@ -107,7 +972,351 @@ class Docker(object):
         if container_name:
             url = url + "?name=" + container_name
 
-        get_url(url, "POST", config_string)
+        output = get_url(url, "POST", config_string)
+        if container_name and output:
+            INVENTORY.add(container_name, output['Id'])
+
+
+class BuildGraph(object):
+    """
+    image builds and the builds each one depends on;
+    run() does them in parallel where they don't depend
+    on each other, and each image is built only once
+    no matter how many times it is added
+    """
+    def __init__(self):
+        self.builds = {}
+        self.order = []
+
+    def add(self, image_name, build, args, deps=None):
+        """
+        add a build of the specified image, done by calling
+        build(*args) once the builds of the images in deps
+        (which must already have been added) have finished
+        """
+        if image_name in self.builds:
+            return
+        self.builds[image_name] = {'build': build, 'args': args,
+                                   'deps': deps or [],
+                                   'done': threading.Event(),
+                                   'failed': False}
+        # dependencies are always added first, so workers
+        # taking builds off the queue in this order only
+        # ever wait for builds that are already under way
+        self.order.append(image_name)
+
+    def do_build(self, image_name):
+        'build one image once its dependencies are built'
+        entry = self.builds[image_name]
+        try:
+            for dep in entry['deps']:
+                self.builds[dep]['done'].wait()
+                if self.builds[dep]['failed']:
+                    raise DockerError("%s failed to build, not building %s"
+                                      % (dep, image_name))
+            entry['build'](*entry['args'])
+        except Exception:
+            entry['failed'] = True
+            raise
+        finally:
+            entry['done'].set()
+
+    def run(self, concurrency):
+        """
+        do all the builds, with at most 'concurrency' at
+        once, and return the list of ones that failed
+        """
+        return run_jobs(self.order, self.do_build, concurrency)
+
+
+class ClusterResolver(object):
+    """
+    minimal dns responder for containers created with it as
+    their Dns server: queries for container names and
+    hostnames are answered from the container inventory
+    (A queries with the ip, others with no records),
+    anything else is passed on to the host's nameserver.
+    ips are rechecked every DNS_TTL seconds, so a restarted
+    container is found at its new address without any
+    changes to other containers; DNS_FORWARDERS threads
+    pass queries on, so a burst of them can't start a
+    thread apiece
+    """
+    def __init__(self, address, port=DNS_PORT, upstream=None):
+        self.address = address
+        self.port = port
+        self.upstream = upstream or get_upstream_nameserver(address)
+        self.search_domains = get_search_domains()
+        self.cache = {}
+        self.inventory_time = 0
+        self.sock = None
+        self.forwards = Queue.Queue(DNS_FORWARD_QUEUE)
+
+    def resolve(self, name):
+        """
+        return whether the name is a container name or hostname,
+        possibly with one of the host's search domains on the
+        end, and the container's ip if it is running, or None
+        """
+        now = time.time()
+        if name in self.cache and self.cache[name][2] > now:
+            return self.cache[name][:2]
+        if now - self.inventory_time > DNS_TTL:
+            INVENTORY.invalidate()
+            self.inventory_time = now
+        candidates = [name] + [name[:-len(domain) - 1]
+                               for domain in self.search_domains
+                               if name.endswith('.' + domain)]
+        info = None
+        for candidate in candidates:
+            info = INVENTORY.lookup_host(candidate)
+            if info is not None:
+                break
+        ip_addr = None
+        if info is not None and info['running']:
+            METADATA.invalidate(info['id'])
+            ip_addr = METADATA.get(info['id'])['ip'] or None
+        self.cache[name] = (info is not None, ip_addr, now + DNS_TTL)
+        return info is not None, ip_addr
+
+    def answer(self, query):
+        """
+        return the response to the query packet if it is
+        for a container, or None to pass it upstream; only
+        A queries for running containers get an answer
+        record, the rest get an empty answer, so that
+        resolvers don't take the name for unknown
+        """
+        if len(query) < 12:
+            return None
+        qdcount = struct.unpack('!H', query[4:6])[0]
+        if qdcount != 1:
+            return None
+        labels = []
+        offset = 12
+        while offset < len(query) and ord(query[offset]):
+            length = ord(query[offset])
+            labels.append(query[offset + 1:offset + 1 + length])
+            offset += length + 1
+        offset += 1
+        if offset + 4 > len(query):
+            return None
+        qtype, qclass = struct.unpack('!HH', query[offset:offset + 4])
+        if qclass != 1 or not labels:
+            return None
+        found, ip_addr = self.resolve('.'.join(labels).lower())
+        if not found:
+            return None
+        # header: same id, response + authoritative, recursion
+        # desired copied over, recursion available; one question
+        # (copied from the query) and the answer, if any,
+        # pointing at it
+        flags = 0x8480 | (struct.unpack('!H', query[2:4])[0] & 0x0100)
+        if qtype != 1 or ip_addr is None:
+            header = query[:2] + struct.pack('!HHHHH', flags, 1, 0, 0, 0)
+            return header + query[12:offset + 4]
+        header = query[:2] + struct.pack('!HHHHH', flags, 1, 1, 0, 0)
+        record = struct.pack('!HHHIH', 0xc00c, 1, 1, DNS_TTL, 4)
+        return (header + query[12:offset + 4] + record +
+                socket.inet_aton(ip_addr))
+
+    def do_forwards(self):
+        'pass on the queued queries one after another, forever'
+        while True:
+            query, client = self.forwards.get()
+            self.forward(query, client)
+
+    def forward(self, query, client):
+        'pass the query to the upstream nameserver and relay its reply'
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(DNS_TTL)
+            sock.sendto(query, (self.upstream, 53))
+            response = sock.recv(4096)
+            self.sock.sendto(response, client)
+        except (socket.error, socket.timeout):
+            pass
+        finally:
+            sock.close()
+
+    def serve_forever(self):
+        'answer queries until interrupted'
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.address, self.port))
+        if self.upstream:
+            start_threads(DNS_FORWARDERS, self.do_forwards)
+        while True:
+            query, client = self.sock.recvfrom(4096)
+            try:
+                response = self.answer(query)
+            except Exception:
+                traceback.print_exc()
+                response = None
+            if response is not None:
+                self.sock.sendto(response, client)
+            elif self.upstream:
+                try:
+                    self.forwards.put_nowait((query, client))
+                except Queue.Full:
+                    pass
+
+
+class EventTelemetry(object):
+    """
+    watch the salt master's event bus while we work: the
+    salt-events.py script runs on the master and streams
+    auth, job publish and job return events back to us, and
+    they are summed up into time buckets (auths, publishes
+    and returns per second, returns still outstanding, and
+    the return latency for minions of each salt version tag)
+    which write() saves as json lines
+    """
+    def __init__(self, master_name, minion_tags, bucket_seconds=TELEMETRY_BUCKET,
+                 duration=TELEMETRY_DURATION):
+        self.master_name = master_name
+        self.minion_tags = minion_tags
+        self.bucket_seconds = bucket_seconds
+        self.duration = duration
+        self.events = []
+        self.lock = threading.Lock()
+        self.http_conn = None
+        self.thread = None
+        self.start_time = None
+
+    def start(self):
+        'copy the event script to the master and start streaming from it'
+        with open(SALT_EVENTS_SCRIPT, 'r') as script:
+            put_files(self.master_name, '/tmp',
+                      {'salt-events.py': script.read()})
+        self.start_time = time.time()
+        self.http_conn, response = start_exec_stream(
+            self.master_name, ['python', '/tmp/salt-events.py',
+                               str(self.duration)])
+        self.thread = start_threads(1, lambda: self.read_events(response))[0]
+
+    def read_events(self, response):
+        'collect the events from the script output until it ends'
+        buf = ""
+        try:
+            for stream, payload in read_exec_frames(response):
+                if stream != 1:
+                    continue
+                buf += payload
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    with self.lock:
+                        self.events.append(record)
+        except (socket.error, httplib.HTTPException):
+            pass
+
+    def wait(self):
+        'wait for the script to finish on its own'
+        self.thread.join()
+
+    def stop(self):
+        'stop streaming; the script goes away when it next writes'
+        try:
+            self.http_conn.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, AttributeError):
+            pass
+        self.http_conn.close()
+        self.thread.join(5)
+
+    def get_buckets(self):
+        """
+        return the events summed up per bucket of time,
+        and the totals over all of them; a job publish or
+        return seen twice (older masters fire each under two
+        tags) is only counted the first time
+        """
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['t'])
+        seen = set()
+        buckets = []
+        latencies = {}
+        published = {}
+        expected = received = 0
+        totals = collections.Counter()
+        for event in events:
+            if event['type'] != 'auth':
+                key = (event['type'], event['jid'], event['id'])
+                if key in seen:
+                    continue
+                seen.add(key)
+            index = int((event['t'] - self.start_time) / self.bucket_seconds)
+            while len(buckets) <= index:
+                buckets.append({'t': len(buckets) * self.bucket_seconds,
+                                'auths': 0, 'publishes': 0, 'returns': 0,
+                                'pending': expected - received,
+                                'latency': {}})
+            bucket = buckets[index]
+            if event['type'] == 'auth':
+                bucket['auths'] += 1
+            elif event['type'] == 'new':
+                bucket['publishes'] += 1
+                published[event['jid']] = event['t']
+                expected += event.get('minions', 0)
+            elif event['type'] == 'ret':
+                bucket['returns'] += 1
+                if event['jid'] in published:
+                    received += 1
+                    tag = self.minion_tags.get(event['id'], 'unknown')
+                    latency = event['t'] - published[event['jid']]
+                    bucket['latency'].setdefault(tag, []).append(latency)
+                    latencies.setdefault(tag, []).append(latency)
+            totals[event['type']] += 1
+            bucket['pending'] = expected - received
+        for bucket in buckets:
+            for name in ['auths', 'publishes', 'returns']:
+                bucket[name + '_per_second'] = (bucket[name] /
+                                                float(self.bucket_seconds))
+            bucket['latency'] = get_latency_stats(bucket['latency'])
+        return buckets, {'auths': totals['auth'],
+                         'publishes': totals['new'],
+                         'returns': totals['ret'],
+                         'latency': get_latency_stats(latencies)}
+
+    def write(self, path):
+        """
+        save a header line, a line for each bucket of time
+        and a line of totals, each as compact json
+        """
+        buckets, totals = self.get_buckets()
+        lines = [{'master': self.master_name, 'start': self.start_time,
+                  'bucket_seconds': self.bucket_seconds}]
+        lines.extend(buckets)
+        lines.append({'totals': totals})
+        with open(path, 'w') as telemetry_file:
+            for line in lines:
+                telemetry_file.write(json.dumps(line, sort_keys=True,
+                                                separators=(',', ':')) + "\n")
+
+
+class PupaasConnectionPool(ConnectionPool):
+    """
+    keep-alive connections to the pupaas server
+    on one container
+    """
+    def __init__(self, instance_name, port, timeout=20, max_idle=2):
+        super(PupaasConnectionPool, self).__init__(self.make_connection,
+                                                   max_idle)
+        self.instance_name = instance_name
+        self.port = port
+        self.timeout = timeout
+
+    def make_connection(self):
+        'make a new connection to the pupaas server'
+        try:
+            return httplib.HTTPConnection(self.instance_name,
+                                          timeout=self.timeout, port=self.port)
+        except Exception:
+            raise httplib.HTTPException(
+                "failed to establish http connection to " +
+                self.instance_name)
 
 
 class PupaasClient(object):
@@ -115,11 +1324,49 @@ class PupaasClient(object):
     the dreaded 'puppet as a service' class
     this knows how to talk to the pupaas server
     and do very simple things like applying a
-    manifest or retrieving a fact
+    manifest or retrieving a fact; connections to
+    each instance are kept alive until close() is
+    called for it
     """
-    def __init__(self, port):
+    def __init__(self, port, timeout=20):
         self.port = port
+        self.timeout = timeout
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, instance_name):
+        'get the connection pool for the specified instance'
+        with self.lock:
+            if instance_name not in self.pools:
+                self.pools[instance_name] = PupaasConnectionPool(
+                    instance_name, self.port, self.timeout)
+            return self.pools[instance_name]
+
+    def close(self, instance_name=None):
+        """
+        close connections to the specified instance,
+        or to all instances if none is specified
+        """
+        with self.lock:
+            if instance_name is None:
+                pools = self.pools.values()
+                self.pools = {}
+            elif instance_name in self.pools:
+                pools = [self.pools.pop(instance_name)]
+            else:
+                pools = []
+        for pool in pools:
+            pool.close()
+
+    @PROFILER.timed('pupaas request')
+    def request(self, instance_name, method, url, contents=None):
+        'send a request to pupaas on the instance, return status and body'
+        return self.get_pool(instance_name).request(
+            url, method, contents,
+            headers={"User-Agent":
+                     "run_salt_client.py/0.0 (salt testbed configurator)"})
 
+    @PROFILER.timed('pupaas apply_manifest')
     def apply_manifest(self, instance_name, manifest):
         """
         apply a puppet manifest via puppet as a service
@@ -127,103 +1374,231 @@ class PupaasClient(object):
         appropriate location)
         """
         url = '/apply/' + manifest
-        method = 'POST'
-        try:
-            http_conn = httplib.HTTPConnection(instance_name,
-                                              timeout=20, port=self.port)
-        except Exception:
-            raise httplib.HTTPException(
-                "failed to establish http connection to " +
-                instance_name)
-
-        http_conn.request(method, url, headers={
-            "User-Agent": "run_salt_client.py/0.0 (salt testbed configurator)"})
         try:
-            response = http_conn.getresponse(buffering=True)
+            status, data = self.request(instance_name, 'POST', url)
         except httplib.HTTPException:
             raise httplib.HTTPException('failed to apply ' + manifest + ' on ' +
-                                instance_name)
+                                        instance_name)
 
-        data = response.read()
-        if response.status == 200 or response.status == 204:
+        if status == 200 or status == 204:
             return True
         else:
             if data:
                 sys.stderr.write(data + "\n")
             raise IOError('failed to apply ' + manifest + ' on ' +
                           instance_name, " with response code " +
-                          str(response.status))
+                          str(status))
 
+    @PROFILER.timed('pupaas add_manifest')
     def add_manifest(self, instance_name, manifest, contents):
         """
         add a puppet manifest to the instance, with the
         specified contents, via puppet as a service
         """
         url = '/manifest/' + manifest
-        method = 'DELETE'
-        try:
-            http_conn = httplib.HTTPConnection(instance_name, timeout=20,
-                                              port=self.port)
-        except Exception:
-            raise httplib.HTTPException(
-                "failed to establish http connection to " + instance_name)
-
-        http_conn.request(method, url, headers={
-            "User-Agent": "run_salt_client.py/0.0 (salt testbed configurator)"})
-        response = http_conn.getresponse(buffering=True)
-        data = response.read()
-        if (response.status != 200 and response.status != 404 and
-            response.status != 201 and response.status != 204):
+        status, data = self.request(instance_name, 'DELETE', url)
+        if (status != 200 and status != 404 and
+            status != 201 and status != 204):
             if data:
                 sys.stderr.write(data + "\n")
             raise IOError('failed to delete ' + manifest + ' on ' +
                           instance_name, " with response code " +
-                          str(response.status))
+                          str(status))
 
-        url = '/manifest/' + manifest
-        method = 'PUT'
-
-        http_conn.request(
-            method, url, contents,
-            headers={"User-Agent":
-                     "run_salt_client.py/0.0 (salt testbed configurator)"})
-        response = http_conn.getresponse(buffering=True)
-        data = response.read()
-        if (response.status == 200 or response.status == 204 or
-            response.status == 201):
+        status, data = self.request(instance_name, 'PUT', url, contents)
+        if status == 200 or status == 204 or status == 201:
             return True
         else:
             if data:
                 sys.stderr.write(data + "\n")
             raise IOError('failed to put ' + manifest + ' on ' +
                           instance_name, " with response code " +
-                          str(response.status))
+                          str(status))
 
+    @PROFILER.timed('pupaas put_manifest')
+    def put_manifest(self, instance_name, manifest, contents):
+        """
+        add or overwrite a puppet manifest on the instance
+        with a single PUT, falling back to deleting it first
+        (see add_manifest) if the server won't overwrite it
+        """
+        url = '/manifest/' + manifest
+        status, _ = self.request(instance_name, 'PUT', url, contents)
+        if status == 200 or status == 204 or status == 201:
+            return True
+        if status >= 400 and status < 500 and status != 404:
+            return self.add_manifest(instance_name, manifest, contents)
+        raise IOError('failed to put ' + manifest + ' on ' +
+                      instance_name, " with response code " +
+                      str(status))
+
+    @PROFILER.timed('pupaas is_reachable')
+    def is_reachable(self, instance_name):
+        'check if pupaas on the instance accepts connections'
+        return is_listening(instance_name, self.port)
+
+    @PROFILER.timed('pupaas wait_until_reachable')
+    def wait_until_reachable(self, instance_name, timeout):
+        'wait until pupaas on the instance accepts connections'
+        wait_until(lambda: self.is_reachable(instance_name),
+                   "pupaas on " + instance_name, timeout)
+
+    def session(self, instance_name):
+        'return a session for working with the specified instance'
+        return PupaasSession(self, instance_name)
+
+    @PROFILER.timed('pupaas get_fact')
     def get_fact(self, instance_name, fact):
         'get a puppet fact from the instance via puppet as a service'
         url = '/fact/' + fact
-        method = 'GET'
-        try:
-            http_conn = httplib.HTTPConnection(instance_name,
-                                              timeout=20, port=self.port)
-        except Exception:
-            raise httplib.HTTPException(
-                "failed to establish http connection to " + instance_name)
-
-        http_conn.request(
-            method, url,
-            headers={"User-Agent":
-                     "run_salt_client.py/0.0 (salt testbed configurator)"})
-        response = http_conn.getresponse(buffering=True)
-        data = response.read()
-        if response.status == 200:
+        status, data = self.request(instance_name, 'GET', url)
+        if status == 200:
             return data.rstrip()
         else:
             if data:
                 sys.stderr.write(data + "\n")
             raise IOError('failed to retrieve fact ' + fact + ' on ' +
                           instance_name, " with response code " +
-                          str(response.status))
+                          str(status))
+
+
+class PupaasSession(object):
+    """
+    a run of pupaas work on one instance, over one persistent
+    connection (as long as the server keeps it open): each
+    manifest goes over with a single PUT and is applied
+    straight away, and the connection is closed at the end
+    """
+    def __init__(self, puppet, instance_name):
+        self.puppet = puppet
+        self.instance_name = instance_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        'close the connection to the instance'
+        self.puppet.close(self.instance_name)
+
+    def run_manifest(self, manifest, contents):
+        'put the manifest on the instance and apply it'
+        self.puppet.put_manifest(self.instance_name, manifest, contents)
+        self.puppet.apply_manifest(self.instance_name, manifest)
+
+    def get_fact(self, fact):
+        'get a puppet fact from the instance'
+        return self.puppet.get_fact(self.instance_name, fact)
+
+
+class PupaasBackend(object):
+    """
+    configure and start or stop salt in the containers
+    with puppet, via puppet as a service
+    """
+    def __init__(self, port, ready_timeout=READY_TIMEOUT):
+        self.puppet = PupaasClient(port)
+        self.ready_timeout = ready_timeout
+
+    def start_master(self, master_name, ip_addr):
+        """
+        configure and start the salt master, and
+        return its key fingerprint (minions need this)
+        """
+        self.puppet.wait_until_reachable(ip_addr, self.ready_timeout)
+        with self.puppet.session(ip_addr) as session:
+            # config file and service in one puppet run, see
+            # get_salt_start_manifest for why that's safe
+            session.run_manifest('manifests/salt_master_start.pp',
+                                 get_salt_start_manifest('master'))
+            # the master must be up and have generated its keys
+            # before we can ask for the fingerprint
+            wait_until(lambda: is_listening(ip_addr, SALT_MASTER_PORT),
+                       "salt master port on " + master_name,
+                       self.ready_timeout)
+            return wait_until(
+                lambda: session.get_fact('salt_key_fingerprint').strip("\n"),
+                "salt master key fingerprint on " + master_name,
+                self.ready_timeout)
+
+    def stop_master(self, master_name, ip_addr):
+        'stop salt on the master'
+        contents = ("import 'salt.pp'\n"
+                    "class { 'salt::master': ensure => 'stopped' }\n")
+        with self.puppet.session(ip_addr or master_name) as session:
+            session.run_manifest('manifests/salt_master_stop.pp', contents)
+
+    def start_minion(self, instance_name, ip_addr, master_name, fingerprint):
+        'configure and start salt on the specified minion'
+        self.puppet.wait_until_reachable(ip_addr, self.ready_timeout)
+        # config file and service in one puppet run, see
+        # get_salt_start_manifest for why that's safe
+        contents = get_salt_start_manifest(
+            'minion', "salt_master => '%s', master_fingerprint => '%s'"
+            % (master_name, fingerprint))
+        with self.puppet.session(ip_addr) as session:
+            session.run_manifest('manifests/salt_minion_start.pp', contents)
+
+    def stop_minion(self, instance_name, ip_addr, master_name, fingerprint):
+        'stop salt on the specified minion'
+        contents = "import 'salt.pp'\nclass { 'salt::minion': ensure => 'stopped', salt_master => '%s', master_fingerprint => '%s' }\n"% (master_name, fingerprint)
+        with self.puppet.session(ip_addr or instance_name) as session:
+            session.run_manifest('manifests/salt_minion_stop.pp', contents)
+
+
+class ExecBackend(object):
+    """
+    configure and start or stop salt in the containers
+    without puppet: config files are rendered here and
+    copied in via the docker api, and the init scripts
+    are run via docker exec
+    """
+    def __init__(self, ready_timeout=READY_TIMEOUT):
+        self.ready_timeout = ready_timeout
+
+    def start_master(self, master_name, ip_addr):
+        """
+        configure and start the salt master, and
+        return its key fingerprint (minions need this)
+        """
+        with open(SALT_MASTER_CONFIG, 'r') as config:
+            put_files(master_name, '/etc', {'salt/master': config.read()})
+        run_command(master_name, ['/etc/init.d/salt-master', 'start'])
+        wait_until(lambda: is_listening(ip_addr, SALT_MASTER_PORT),
+                   "salt master port on " + master_name, self.ready_timeout)
+        return wait_until(lambda: self.get_fingerprint(master_name),
+                          "salt master key fingerprint on " + master_name,
+                          self.ready_timeout)
+
+    def get_fingerprint(self, master_name):
+        """
+        get the master key fingerprint the same way the
+        salt_key_fingerprint fact does
+        """
+        _, output = exec_command(master_name, [
+            '/usr/local/bin/salt-key', '-f', 'master.pub'])
+        match = re.search(r'^master\.pub:  (\S+)', output, re.MULTILINE)
+        if not match:
+            return None
+        return match.group(1)
+
+    def stop_master(self, master_name, ip_addr):
+        'stop salt on the master'
+        run_command(master_name, ['/etc/init.d/salt-master', 'stop'])
+
+    def start_minion(self, instance_name, ip_addr, master_name, fingerprint):
+        'configure and start salt on the specified minion'
+        config = render_minion_config(master_name,
+                                      METADATA.get(instance_name)['hostname'],
+                                      fingerprint)
+        put_files(instance_name, '/etc', {'salt/minion': config})
+        run_command(instance_name, ['/etc/init.d/salt-minion', 'start'])
+
+    def stop_minion(self, instance_name, ip_addr, master_name, fingerprint):
+        'stop salt on the specified minion'
+        run_command(instance_name, ['/etc/init.d/salt-minion', 'stop'])
 
 
 class SaltMaster(object):
@@ -231,41 +1606,35 @@ class SaltMaster(object):
     manage configuration, starting and stopping
     a salt master container
     """
-    def __init__(self, prefix, tag_text, puppet):
+    def __init__(self, prefix, tag_text, backend):
         self.tag = get_salt_tag_from_text("1:" + tag_text)
         self.hostname = self.get_name(prefix)
         self.fingerprint = None
+        self.expected_fingerprint = None
         self.ip_addr = None
         self.ip_host = {}
-        self.puppet = puppet
+        self.backend = backend
 
     def start_salt(self):
-        'start salt on the master container'
-        # set up config file first, so we don't hit puppet bug
-        # 7165 (ensure running causes start, refresh from file
-        # update causes restart, fixed in puppet 3.2)
-        # the salt master doesn't do well withthe quick start-restart
-        contents = ("import 'salt.pp'\n"
-                    "class { 'salt::master::conffile':}\n")
-        self.puppet.add_manifest(self.ip_addr,
-                                 'manifests/salt_master_config.pp', contents)
-        self.puppet.apply_manifest(self.ip_addr,
-                                   'manifests/salt_master_config.pp')
-        contents = ("import 'salt.pp'\n"
-                    "class { 'salt::master': ensure => 'running' }\n")
-        self.puppet.add_manifest(self.ip_addr,
-                                 'manifests/salt_master_start.pp', contents)
-        self.puppet.apply_manifest(self.ip_addr,
-                                   'manifests/salt_master_start.pp')
+        """
+        start salt on the master container and save its
+        key fingerprint; if we already know what the
+        fingerprint should be (we made the master keys),
+        check that the master is really using those keys
+        """
+        fingerprint = self.backend.start_master(self.hostname, self.ip_addr)
+        if (self.expected_fingerprint and
+                fingerprint != self.expected_fingerprint):
+            raise DockerError("Salt master %s has key fingerprint %s, "
+                              "not %s from the keys we made for it; was "
+                              "its container created without them?" %
+                              (self.hostname, fingerprint,
+                               self.expected_fingerprint))
+        self.fingerprint = fingerprint
 
     def stop_salt(self):
         'stop salt on the master'
-        contents = ("import 'salt.pp'\n"
-                    "class { 'salt::master': ensure => 'stopped' }\n")
-        self.puppet.add_manifest(self.hostname,
-                                 'manifests/salt_master_stop.pp', contents)
-        self.puppet.apply_manifest(self.hostname,
-                                   'manifests/salt_master_stop.pp')
+        self.backend.stop_master(self.hostname, self.ip_addr)
 
     def configure_container(self):
         """
@@ -273,28 +1642,25 @@ class SaltMaster(object):
         its key fingerprint (minions need this)
         """
 
-        # get salt master ip
+        self.get_ip_addr()
+        self.start_salt()
+
+    def get_ip_addr(self):
+        'get salt master ip, if we do not have it already'
         if not self.ip_addr:
             self.ip_addr = get_ip(self.hostname)
             self.ip_host[self.hostname] = self.ip_addr
+        return self.ip_addr
 
-        self.start_salt()
-        # need this so master can generate keys before we ask for them
-        time.sleep(5)
-        self.fingerprint = self.get_salt_key_fingerprint(self.ip_addr)
-
-    def get_salt_key_fingerprint(self, instance_name):
+    def start_container(self):
         """
-        get the salt master key fingeprint
-        via puppet as a service on the container
+        start the salt master container if it isn't
+        running, returning whether it had to be started
         """
-        result = self.puppet.get_fact(instance_name, 'salt_key_fingerprint')
-        return result.strip("\n")
-
-    def start_container(self):
-        'start the salt master container'
-        if not is_running(self.hostname):
-            start_container(self.hostname)
+        if is_running(self.hostname):
+            return False
+        start_container(self.hostname)
+        return True
 
     def get_name(self, prefix):
         """
@@ -321,28 +1687,54 @@ class SaltCluster(object):
     """
     def __init__(self, master_prefix, saltminion_prefix, paas_port,
                  docker_path, minion_tags_text, master_tag,
-                 docker_create, docker_force, verbose):
+                 docker_create, docker_force, verbose, concurrency=1,
+                 ready_timeout=READY_TIMEOUT, backend='pupaas',
+                 state_dir=STATE_DIR, preseed_master=False,
+                 preseed_minions=False, shared_hosts=False, dns=None,
+                 retries=RETRIES):
         self.repo = 'ariel/salt'
         self.verbose = verbose
-        self.saltminion_prefix = saltminion_prefix
-        self.minion_tags_text = minion_tags_text
-        self.minion_tags = self.get_minion_tags()
         self.docker_path = docker_path
         self.docker_create = docker_create
-        if not self.docker_create:
-            self.puppet = PupaasClient(paas_port)
+        if backend == 'exec':
+            self.backend = ExecBackend(ready_timeout)
         else:
-            self.puppet = None
+            self.backend = PupaasBackend(paas_port, ready_timeout)
+        self.master = SaltMaster(master_prefix, master_tag, self.backend)
+        self.state = ClusterState(os.path.join(
+            state_dir, self.master.hostname, 'state.json'))
+        # the master fingerprint is kept from the last configure,
+        # and the minions from the last run if none are given
+        self.master.fingerprint = self.state.get('master').get('fingerprint')
+        if minion_tags_text is None:
+            minion_tags_text = self.state.get('minion_tags')
+            saltminion_prefix = self.state.get('minion_prefix',
+                                               saltminion_prefix)
+        self.saltminion_prefix = saltminion_prefix
+        self.minion_tags_text = minion_tags_text
+        self.minion_tags = self.get_minion_tags()
         self.minion_count = None
         self.docker_force = docker_force
-        self.docker = Docker(docker_path)
+        self.docker = Docker(docker_path, verbose)
         self.minion_ips_hosts = {}
         self.minion_count = self.get_minion_count()
-        self.master = SaltMaster(master_prefix, master_tag,
-                                 self.puppet)
-        self.queue = None
-        self.stop_completed = False
-        self.config_completed = False
+        self.concurrency = concurrency
+        self.base_hashes = {}
+        self.state_dir = state_dir
+        self.preseed_master = preseed_master
+        self.master_keys = None
+        self.preseed_minions = preseed_minions
+        self.shared_hosts = shared_hosts
+        self.dns = dns
+        self.retries = retries
+        self.summary = []
+        self.telemetry = None
+        # VersionMatrix hands clusters that may share images a
+        # shared lock, so that each image is only built once
+        self.build_lock = threading.Lock()
+        self.created_minions = []
+        self.minion_pub_keys = {}
+        self.lock = threading.Lock()
 
     def get_minion_tags(self):
         """
@@ -360,6 +1752,127 @@ class SaltCluster(object):
             salt_tags.append(get_salt_tag_from_text(entry))
         return salt_tags
 
+    def get_concurrency(self):
+        """
+        return the number of instances to work on at once
+        for the current phase, working it out from the
+        host's resources if we were asked to pick it
+        """
+        if self.concurrency != 'auto':
+            return self.concurrency
+        concurrency = get_auto_concurrency()
+        display(self.verbose, "Working on %d instances at once" % concurrency)
+        return concurrency
+
+    def report_failures(self, phase, failures, what="container"):
+        'complain about each instance that failed in the given phase'
+        for failure in failures:
+            if self.verbose and failure['traceback']:
+                sys.stderr.write(failure['traceback'])
+            sys.stderr.write("problem %s %s %s (%s: %s)\n" % (
+                phase, what, failure['instance'], failure['error'],
+                failure['message']))
+
+    def run_phase(self, phase, verb, todo, target, concurrency=None):
+        """
+        call target(item) for each item in todo via run_jobs,
+        then retry the items that failed, backing off between
+        tries, up to self.retries times; report and save what
+        still failed at the end, add the phase to the summary
+        and return the failures
+        """
+        if concurrency is None:
+            concurrency = self.get_concurrency()
+        if PROFILER.enabled:
+            target = self.get_timed_target(phase, target)
+        failures = run_jobs(todo, target, concurrency)
+        attempts = {}
+        delay = RETRY_DELAY
+        for attempt in range(1, self.retries + 1):
+            if not failures:
+                break
+            for failure in failures:
+                display(self.verbose, "Retrying %s %s after %s: %s" % (
+                    verb, failure['instance'], failure['error'],
+                    failure['message']))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = delay * 2
+            # what we knew about them may be what went wrong
+            names = [self.get_instance_name(failure['instance'])
+                     for failure in failures]
+            INVENTORY.invalidate(names)
+            for name in names:
+                METADATA.invalidate(name)
+            items = [failure['instance'] for failure in failures]
+            for item in items:
+                attempts[item] = attempt
+            failures = run_jobs(items, target, concurrency)
+        for failure in failures:
+            failure['attempts'] = attempts.get(failure['instance'], 0) + 1
+        self.report_failures(verb, failures)
+        self.record_failures(phase, failures)
+        self.add_summary(phase, len(todo), failures, len(attempts))
+        return failures
+
+    def get_timed_target(self, phase, target):
+        'wrap the job target so the time for each instance is recorded'
+        def timed_target(item):
+            'call target(item) and record how long it took'
+            start = time.time()
+            try:
+                target(item)
+            finally:
+                PROFILER.record_instance(phase, self.get_instance_name(item),
+                                         time.time() - start)
+        return timed_target
+
+    def add_summary(self, phase, count, failures, retried=0):
+        """
+        add the results of a phase to the summary: how many
+        instances it covered, how many had to be retried, and
+        the instances that failed in the end with their errors
+        """
+        self.summary.append({
+            'phase': phase, 'instances': count, 'retried': retried,
+            'failed': [dict((key, failure.get(key)) for key in
+                            ['instance', 'error', 'message', 'attempts'])
+                       for failure in failures]})
+
+    def get_instance_name(self, item):
+        'return the container name for a job item, a name or minion number'
+        if isinstance(item, basestring):
+            return item
+        return self.get_salt_minion_name(item)
+
+    def sync_state(self):
+        """
+        check the saved state against the container inventory,
+        forgetting about containers that are gone or recreated
+        """
+        self.state.sync()
+        info = INVENTORY.lookup(self.master.hostname)
+        master_id = self.state.get('master').get('id')
+        if info is None or (master_id and master_id != info['id']):
+            self.state.set('master', {})
+            self.master.fingerprint = None
+
+    def record_failures(self, phase, failures):
+        'save the errors for the instances that failed in the given phase'
+        for failure in failures:
+            if failure['instance'] == self.master.hostname:
+                self.state.update_master(
+                    phase=phase + ' failed',
+                    error="%s failed: %s: %s" % (phase, failure['error'],
+                                                  failure['message']))
+                continue
+            if isinstance(failure['instance'], basestring):
+                continue
+            self.state.update_instance(
+                self.get_salt_minion_name(failure['instance']),
+                instance=failure['instance'], phase=phase + ' failed',
+                error="%s failed: %s: %s" % (phase, failure['error'],
+                                              failure['message']))
+
     def get_minion_count(self):
         """
         get the total number of minions by looking at
@@ -372,30 +1885,74 @@ class SaltCluster(object):
             count = count + int(entry['minions'])
         return count
 
-    def start_salt_minion(self, instance_name):
+    def start_salt_minion(self, instance_name, ip_addr):
         'start salt on the specified instance'
-        contents = "import 'salt.pp'\nclass { 'salt::minion::conffile': salt_master => '%s', master_fingerprint => '%s' }\n" % (self.master.hostname, self.master.fingerprint)
-        self.puppet.add_manifest(instance_name,
-                                 'manifests/salt_minion_config.pp',
-                                 contents)
-        self.puppet.apply_manifest(instance_name,
-                                   'manifests/salt_minion_config.pp')
-
-        contents = "import 'salt.pp'\nclass { 'salt::minion': ensure => 'running', salt_master => '%s', master_fingerprint => '%s' }\n" % (self.master.hostname, self.master.fingerprint)
-        self.puppet.add_manifest(instance_name,
-                                 'manifests/salt_minion_start.pp',
-                                 contents)
-        self.puppet.apply_manifest(instance_name,
-                                   'manifests/salt_minion_start.pp')
-
-    def stop_salt_minion(self, instance_name):
+        self.backend.start_minion(instance_name, ip_addr,
+                                  self.master.hostname, self.master.fingerprint)
+
+    def stop_salt_minion(self, instance_name, ip_addr=None):
         'stop salt on the specified instance'
-        contents = "import 'salt.pp'\nclass { 'salt::master': ensure => 'stopped', salt_master => '%s', master_fingerprint => '%s' }\n"% (self.master.hostname, self.master.fingerprint)
-        self.puppet.add_manifest(instance_name,
-                                 'manifests/salt_minion_stop.pp',
-                                 contents)
-        self.puppet.apply_manifest(instance_name,
-                                   'manifests/salt_minion_stop.pp')
+        self.backend.stop_minion(instance_name, ip_addr,
+                                 self.master.hostname, self.master.fingerprint)
+
+    def get_todo(self, instance_no):
+        """
+        return the list of minion instance numbers to work on:
+        all of them if instance_no is None, otherwise the one
+        number or the list of numbers given
+        """
+        if instance_no is None:
+            return range(1, self.minion_count + 1)
+        if isinstance(instance_no, list):
+            return instance_no
+        return [instance_no]
+
+    def select_instances(self, text):
+        """
+        given a text string like 5-40,77,trusty:*:deb return
+        the sorted list of instance numbers it selects: each
+        entry is an instance number, a range of them, or a
+        minion tag (image, salt version, package type, with
+        '*' matching anything) selecting all of its minions;
+        raises ValueError for entries that make no sense
+        """
+        selected = set()
+        for entry in text.split(','):
+            entry = entry.strip()
+            if ':' in entry:
+                numbers = self.get_tag_instances(entry)
+                if not numbers:
+                    raise ValueError("no minions with tag " + entry)
+                selected.update(numbers)
+                continue
+            fields = entry.split('-')
+            if len(fields) > 2 or not all(field.isdigit() for field in fields):
+                raise ValueError("%s is not a number, range or tag" % entry)
+            first, last = int(fields[0]), int(fields[-1])
+            if first < 1 or last > self.minion_count or first > last:
+                raise ValueError("%s is not within 1-%d" %
+                                 (entry, self.minion_count))
+            selected.update(range(first, last + 1))
+        return sorted(selected)
+
+    def get_tag_instances(self, tag_text):
+        """
+        return the instance numbers of the minions whose tag
+        matches <image>:<saltvers>:<ptype>, any of which may be '*'
+        """
+        wanted = tag_text.split(':')
+        if len(wanted) != 3:
+            raise ValueError("tag %s is not <image>:<saltvers>:<ptype>" %
+                             tag_text)
+        numbers = []
+        first = 1
+        for entry in self.minion_tags:
+            last = first + int(entry['minions'])
+            fields = [entry['image'], entry['version'], entry['package']]
+            if all(want in ('*', field) for want, field in zip(wanted, fields)):
+                numbers.extend(range(first, last))
+            first = last
+        return numbers
 
     def get_salt_minion_name(self, instance_number):
         """
@@ -410,9 +1967,8 @@ class SaltCluster(object):
         for entry in self.minion_tags:
             count = count + int(entry['minions'])
             if count >= instance_number:
-                return ("-".join([self.saltminion_prefix, str(instance_number),
-                                  entry['image'], sanitize(entry['version']),
-                                  entry['package']]))
+                return get_minion_name(self.saltminion_prefix,
+                                       instance_number, entry)
         return None
 
     def start_minion_container(self, instance_number):
@@ -425,108 +1981,444 @@ class SaltCluster(object):
         instance_name = self.get_salt_minion_name(instance_number)
         start_container(instance_name)
 
+    @PROFILER.timed('start', phase=True)
     def start_cluster(self, instance_no=None):
         """
         start the salt master container followed
         by the minion containers
         """
+        self.invalidate_caches()
+        self.sync_state()
         display(self.verbose, "Starting salt master container...")
-        self.master.start_container()
-
-        if instance_no:
-            todo = [instance_no]
-        else:
-            todo = range(1, self.minion_count + 1)
-
-        for i in todo:
-            display(self.verbose, "Starting minion container " + str(i) + "...")
-            self.start_minion_container(i)
+        # a master that was already running keeps its record,
+        # so it can still be found to be configured
+        if self.master.start_container():
+            self.state.update_master(phase='started')
+
+        todo = self.get_todo(instance_no)
+
+        failures = self.run_phase("start", "starting", todo, self.do_start_job)
+        self.state.save()
+        return failures
+
+    def do_start_job(self, instance_number):
+        'start the specified minion container, as a job for run_jobs'
+        display(self.verbose, "Starting minion container " +
+                str(instance_number) + "...")
+        self.start_minion_container(instance_number)
+        self.state.update_instance(self.get_salt_minion_name(instance_number),
+                                   instance=instance_number, phase='started',
+                                   error=None)
 
     def configure_minion_container(self, instance_name, ip_addr):
         """
         update the etc hosts file on the specified container
         (so it knows the ip address of the master, container
         ips are generated anew every time they are restarted)
-        and then start the salt minion on it
+        unless it uses the shared cluster hosts file, which
+        is already up to date, or the cluster dns resolver,
+        and then start the salt minion
         """
-        update_etc_hosts(instance_name, self.master.ip_host)
-        self.start_salt_minion(ip_addr)
+        if self.needs_hosts_update(instance_name):
+            update_etc_hosts(instance_name, self.master.ip_host)
+        self.start_salt_minion(instance_name, ip_addr)
 
-    def do_config_jobs(self):
+    def do_config_job(self, instance_number):
         """
-        get jobs off the queue (a minion
-        instance number plus an ip) and update their
-        /etc/hosts file of that minion with the
-        specified ip, until another thread tells me I
-        am done (by setting the stop_completed var)
+        update the /etc/hosts file of the specified minion
+        and configure salt on it, as a job for run_jobs
         """
-        while not self.config_completed:
-            # fixme when do we know there will be no
-            # more jobs for us on the queue?
-
-            try:
-                (i, instance_name, ip_addr) = self.queue.get(True, 1)
-            except Queue.Empty:
-                continue
-
-            display(self.verbose, "Configuring salt minion " + str(i) +"...")
-            try:
-                self.configure_minion_container(instance_name, ip_addr)
-            except Exception:
-                traceback.print_exc(file=sys.stderr)
-#                traceback.print_stack(file=sys.stderr)
-                sys.stderr.write("problem configuring container " +
-                                 str(i) + ", continuing\n")
-            self.queue.task_done()
-
-    def configure_cluster(self, instance_no=None):
+        instance_name = self.get_salt_minion_name(instance_number)
+        ip_addr = self.minion_ips_hosts[instance_name]
+        # a container restarted since (even at the same ip)
+        # no longer has salt running, so it counts as a change
+        configured = {'phase': 'configured', 'ip': ip_addr,
+                      'master_ip': self.master.ip_addr,
+                      'fingerprint': self.master.fingerprint,
+                      'started': METADATA.get(instance_name)['started']}
+        saved = self.state.get_instance(instance_name)
+        if all(saved.get(key) == configured[key] for key in configured):
+            # nothing changed since we last configured it
+            display(self.verbose, "Salt minion " + str(instance_number) +
+                    " is already configured")
+            return
+        display(self.verbose, "Configuring salt minion " +
+                str(instance_number) + "...")
+        self.configure_minion_container(instance_name, ip_addr)
+        self.state.update_instance(instance_name, instance=instance_number,
+                                   error=None, **configured)
+
+    @PROFILER.timed('configure', phase=True)
+    def configure_cluster(self, instance_no=None, keep_master=False):
         """
         configure the salt master
         update the /etc/hosts on the master with ips
           of all minions
         update /etc/hosts on each minion with the master ip
+        if keep_master is set, the master is left alone if
+        it has not changed since it was last configured
+        """
+        self.invalidate_caches()
+        self.sync_state()
+        # configuration is slow (puppet apply, salt key generation
+        # etc) so do concurrent in batches
+        master_threads = []
+        master_failures = []
+        saved = self.state.get('master')
+        # the fingerprint is only saved once it is configured,
+        # and a restart (even at the same ip) changes 'started'
+        if (keep_master and saved.get('fingerprint') and
+                is_running(self.master.hostname) and
+                saved.get('ip') == self.master.get_ip_addr() and
+                saved.get('started') ==
+                METADATA.get(self.master.hostname)['started']):
+            display(self.verbose, "Salt master is already configured")
+            self.master.fingerprint = saved['fingerprint']
+        elif self.preseed_master:
+            display(self.verbose, "Pre-configuring salt master...")
+            # we made the master keys, so the minions can be given
+            # the fingerprint without waiting for the master to start
+            self.master.get_ip_addr()
+            self.master.fingerprint = self.get_master_keys()['fingerprint']
+            self.master.expected_fingerprint = self.master.fingerprint
+            master_threads = start_threads(1, lambda: master_failures.extend(
+                self.run_phase("configure master", "configuring",
+                               [self.master.hostname],
+                               self.do_master_config_job, 1)))
+        else:
+            display(self.verbose, "Pre-configuring salt master...")
+            master_failures = self.run_phase(
+                "configure master", "configuring", [self.master.hostname],
+                self.do_master_config_job, 1)
+            if master_failures:
+                # without the master's fingerprint no minion can be
+                # configured, so don't try
+                self.state.save()
+                return master_failures
+
+        concurrency = self.get_concurrency()
+
+        # collect all the ips, we need them for master /etc/hosts;
+        # inspect everything up front, concurrently
+        METADATA.prefetch([self.get_salt_minion_name(i)
+                           for i in range(1, self.minion_count + 1)],
+                          concurrency)
+        for i in range(1, self.minion_count + 1):
+            instance_name = self.get_salt_minion_name(i)
+            ip_addr = get_ip(instance_name)
+            self.minion_ips_hosts[instance_name] = ip_addr
+
+        # containers created with the shared cluster hosts file
+        # all see it, so it only needs writing once, before any
+        # minion needs the master's address
+        if self.uses_shared_hosts():
+            display(self.verbose, "Writing cluster hosts file...")
+            self.master.get_ip_addr()
+            write_hosts_file(self.get_shared_hosts_path(),
+                             self.get_cluster_hosts())
+
+        todo = self.get_todo(instance_no)
+
+        failures = self.run_phase("configure", "configuring", todo,
+                                  self.do_config_job, concurrency)
+        for thr in master_threads:
+            thr.join()
+        failures = master_failures + failures
+
+        if self.needs_hosts_update(self.master.hostname):
+            display(self.verbose, "Updating /etc/hosts on salt master...")
+            update_etc_hosts(self.master.hostname, self.minion_ips_hosts)
+        self.state.save()
+        return failures
+
+    def get_shared_hosts_path(self):
+        'return the path of the hosts file shared by the cluster containers'
+        return os.path.join(os.path.abspath(self.state_dir),
+                            self.master.hostname, 'hosts')
+
+    def has_shared_hosts(self, instance_name):
+        """
+        check whether the container has the shared cluster
+        hosts file mounted as its /etc/hosts
+        """
+        return (METADATA.get(instance_name)['shared_hosts'] ==
+                self.get_shared_hosts_path())
+
+    def needs_hosts_update(self, instance_name):
+        """
+        check whether the container's own hosts file needs
+        the cluster entries written into it; not so if it uses
+        the shared hosts file or has the cluster resolver as
+        its dns server (other dns servers don't know about
+        the cluster)
+        """
+        resolver = self.get_resolver_address()
+        return not (self.has_shared_hosts(instance_name) or
+                    (resolver is not None and
+                     resolver in METADATA.get(instance_name)['dns']))
+
+    def get_resolver_address(self):
+        """
+        return the address of the cluster resolver the
+        containers were created with, or None
+        """
+        dns = self.dns or self.state.get('dns')
+        return dns[0] if dns else None
+
+    def uses_shared_hosts(self):
+        'check whether any of the cluster containers use the shared hosts file'
+        return any(self.has_shared_hosts(name) for name in
+                   [self.master.hostname] + self.minion_ips_hosts.keys())
+
+    def get_cluster_hosts(self):
+        """
+        return a dict of ip addresses for the container names
+        and hostnames of the master and all minions, for the
+        shared hosts file; containers use it for their own
+        hostname too, since docker doesn't manage it for them
+        """
+        hosts_ips = {}
+        for name in [self.master.hostname] + self.minion_ips_hosts.keys():
+            entry = METADATA.get(name)
+            hosts_ips[name] = entry['ip']
+            hosts_ips[entry['hostname']] = entry['ip']
+        return hosts_ips
+
+    def get_create_binds(self):
+        """
+        return the bind mounts for new cluster containers:
+        the shared cluster hosts file, if we are using one,
+        which is created with just the localhost entries if
+        it doesn't exist yet (docker would make a directory)
         """
-        # configuration is slow (puppet apply, salt key generation
-        # etc) so do concurrent in batches
-        display(self.verbose, "Pre-configuring salt master...")
+        if not self.shared_hosts:
+            return None
+        hosts_path = self.get_shared_hosts_path()
+        if not os.path.exists(hosts_path):
+            if not os.path.exists(os.path.dirname(hosts_path)):
+                os.makedirs(os.path.dirname(hosts_path), 0700)
+            write_hosts_file(hosts_path, {})
+        return [hosts_path + ":/etc/hosts"]
+
+    def do_master_config_job(self, master_name):
+        'configure the salt master, as a job for run_jobs'
+        # until this succeeds it doesn't count as configured
+        self.state.update_master(phase='configuring', fingerprint=None)
         self.master.configure_container()
+        self.state.update_master(
+            phase='configured', ip=self.master.ip_addr,
+            fingerprint=self.master.fingerprint, error=None,
+            started=METADATA.get(self.master.hostname)['started'])
 
-        self.config_completed = False
-        self.queue = Queue.Queue()
-        if instance_no:
-            num_threads = 1  # :-P
-        else:
-            # maybe a bug.  serious issues with multiple threads
-            num_threads = 1
-        threads = start_threads(num_threads, self.do_config_jobs)
-
-         # collect all the ips, we need them for master /etc/hosts
-        for i in range(1, self.minion_count + 1):
-            instance_name = self.get_salt_minion_name(i)
-            ip_addr = get_ip(instance_name)
-            self.minion_ips_hosts[instance_name] = ip_addr
+    def get_master_keys(self):
+        """
+        get the keys we made for the salt master, making
+        them first if they aren't in the state directory
+        """
+        if self.master_keys is None:
+            key_dir = os.path.join(self.state_dir, self.master.hostname, 'pki')
+            self.master_keys = get_keys(key_dir, 'master', MASTER_KEY_SIZE)
+        return self.master_keys
 
-        if instance_no:
-            todo = [instance_no]
+    @PROFILER.timed('reconcile', phase=True)
+    def reconcile_cluster(self):
+        """
+        bring the existing cluster in line with the minion
+        tags: delete minions that aren't wanted any more
+        (including those whose tag changed, since the tag
+        is part of the name), create, start and configure
+        the ones that are missing or stopped and leave the
+        rest alone; the master hosts file gets one update
+        """
+        self.invalidate_caches()
+        self.sync_state()
+        wanted = dict((self.get_salt_minion_name(number), number)
+                      for number in self.get_todo(None))
+        surplus = [name for name in self.get_existing_minions()
+                   if name not in wanted]
+        missing = sorted(wanted[name] for name in wanted
+                         if not container_exists(name))
+        stopped = sorted(wanted[name] for name in wanted
+                         if container_exists(name) and not is_running(name))
+        master_running = is_running(self.master.hostname)
+        failures = []
+
+        if surplus:
+            display(self.verbose, "Deleting %d surplus minions..." %
+                    len(surplus))
+            failures.extend(self.run_phase("delete", "deleting", surplus,
+                                           self.do_delete_name_job))
+        if missing or not container_exists(self.master.hostname):
+            display(self.verbose, "Creating %d new minions..." % len(missing))
+            failures.extend(self.create_cluster(missing))
+        self.state.set('minion_tags', self.minion_tags_text)
+        self.state.set('minion_prefix', self.saltminion_prefix)
+
+        failed = set(failure['instance'] for failure in failures)
+        to_start = [number for number in sorted(missing + stopped)
+                    if number not in failed]
+        if to_start or not master_running:
+            failures.extend(self.start_cluster(to_start))
+            failed = set(failure['instance'] for failure in failures)
+            # a restarted master has a new ip, so every minion
+            # needs configuring again
+            if master_running:
+                to_configure = [number for number in to_start
+                                if number not in failed]
+            else:
+                to_configure = None
+            failures.extend(self.configure_cluster(to_configure,
+                                                   keep_master=True))
+        elif surplus:
+            # the master still has the deleted minions in its hosts
+            self.update_master_hosts()
         else:
-            todo = range(1, self.minion_count + 1)
-
-        for i in todo:
-            instance_name = self.get_salt_minion_name(i)
-            update_etc_hosts(instance_name, self.master.ip_host)
-            self.queue.put_nowait((i, instance_name,
-                                   self.minion_ips_hosts[instance_name]))
+            display(self.verbose, "Cluster already matches the minion tags")
+        self.state.save()
+        return failures
 
-        # everything on the queue done?
-        self.queue.join()
+    @PROFILER.timed('benchmark', phase=True)
+    def benchmark_cluster(self, load):
+        """
+        load test the salt master: run the salt-load.py script
+        on it, which sends jobs (load['function'] with
+        load['args']) to all minions at load['rate'] jobs a
+        second with at most load['concurrency'] in flight,
+        then report the return latencies, returns that never
+        came and jobs per second; minions missing returns
+        count as failures
+        """
+        self.invalidate_caches()
+        names = [self.get_salt_minion_name(number)
+                 for number in self.get_todo(None)]
+        METADATA.prefetch(names, self.get_concurrency())
+        # minion ids are the container hostnames
+        minion_ids = dict((METADATA.get(name)['hostname'], name)
+                          for name in names if is_running(name))
+        params = dict(BENCHMARK_DEFAULTS, target='*')
+        params.update(load)
+        with open(SALT_LOAD_SCRIPT, 'r') as script:
+            put_files(self.master.hostname, '/tmp',
+                      {'salt-load.py': script.read()})
+        display(self.verbose, "Sending %d %s jobs to %d minions..." % (
+            params['jobs'], params['function'], len(minion_ids)))
+        # the whole run is one exec, so wait for all of it
+        timeout = (params['jobs'] / float(params['rate']) +
+                   params['timeout'] + READY_TIMEOUT)
+        output = run_command(self.master.hostname,
+                             ['python', '/tmp/salt-load.py',
+                              json.dumps(params)], timeout)
+        lines = [line for line in output.splitlines() if line.startswith('{')]
+        if not lines:
+            raise DockerError("No results from load test on " +
+                              self.master.hostname + ": " + output)
+        report = get_load_report(json.loads(lines[-1]), minion_ids)
+        print get_load_summary(report)
+        failures = [{'instance': minion_ids[minion_id],
+                     'error': 'MissingReturn',
+                     'message': "%d of %d jobs" % (missing, params['jobs']),
+                     'attempts': 1}
+                    for minion_id, missing in report['missing_by_minion']]
+        self.add_summary("benchmark", len(minion_ids), failures)
+        self.summary[-1]['benchmark'] = report
+        return failures
+
+    def start_telemetry(self, bucket_seconds, duration):
+        """
+        start watching the salt master event bus, with
+        the events of each minion labelled by its tag
+        """
+        self.invalidate_caches()
+        numbers = self.get_todo(None)
+        names = [self.get_salt_minion_name(number) for number in numbers]
+        METADATA.prefetch(names, self.get_concurrency())
+        minion_tags = {}
+        for number, name in zip(numbers, names):
+            if container_exists(name):
+                tag = self.get_tag(number)
+                minion_tags[METADATA.get(name)['hostname']] = ":".join(
+                    [tag['image'], tag['version'], tag['package']])
+        display(self.verbose, "Watching salt master event bus...")
+        self.telemetry = EventTelemetry(self.master.hostname, minion_tags,
+                                        bucket_seconds, duration)
+        self.telemetry.start()
+
+    def stop_telemetry(self, path, wait=False):
+        """
+        stop watching the salt master event bus (or if wait
+        is set, wait until the watching times out by itself)
+        and write out what we saw
+        """
+        if wait:
+            self.telemetry.wait()
+        self.telemetry.stop()
+        self.telemetry.write(path)
+        display(self.verbose, "Salt master events written to " + path)
 
-        # notify threads to go home, and wait for them to do so
-        self.config_completed = True
-        for thr in threads:
-            thr.join()
+    def get_existing_minions(self):
+        """
+        return the names of the existing minion containers
+        this cluster made, whatever their tag
+        """
+        return sorted(name for name in self.get_known_minions()
+                      if container_exists(name))
 
-        display(self.verbose, "Updating /etc/hosts on salt master...")
-        update_etc_hosts(self.master.hostname, self.minion_ips_hosts)
+    def get_known_minions(self):
+        """
+        return the names of the minion containers this cluster
+        may have made: those in the saved state, and those named
+        for the minion tags the cluster was last set up with;
+        other containers that just happen to share the prefix
+        are none of our business
+        """
+        names = set(self.state.get('minions'))
+        saved_tags = self.state.get('minion_tags')
+        if saved_tags:
+            names.update(get_minion_names(
+                self.state.get('minion_prefix', self.saltminion_prefix),
+                saved_tags))
+        return names
+
+    def invalidate_caches(self):
+        """
+        forget what we know about the containers of this
+        cluster, at the start of a phase; other clusters
+        may be using the caches at the same time (see
+        VersionMatrix), so theirs are left alone
+        """
+        names = self.get_known_minions()
+        names.update(self.get_salt_minion_name(number)
+                     for number in range(1, (self.minion_count or 0) + 1))
+        names.add(self.master.hostname)
+        INVENTORY.invalidate(names)
+        for name in names:
+            METADATA.invalidate(name)
+
+    def update_master_hosts(self):
+        """
+        bring the salt master's hosts entries (or the shared
+        hosts file) in line with the minions there are now
+        """
+        names = [self.get_salt_minion_name(i)
+                 for i in range(1, self.minion_count + 1)]
+        METADATA.prefetch(names, self.get_concurrency())
+        self.minion_ips_hosts = dict((name, get_ip(name)) for name in names)
+        if self.uses_shared_hosts():
+            display(self.verbose, "Writing cluster hosts file...")
+            self.master.get_ip_addr()
+            write_hosts_file(self.get_shared_hosts_path(),
+                             self.get_cluster_hosts())
+        if self.needs_hosts_update(self.master.hostname):
+            display(self.verbose, "Updating /etc/hosts on salt master...")
+            update_etc_hosts(self.master.hostname, self.minion_ips_hosts)
+
+    def do_delete_name_job(self, instance_name):
+        'stop and delete the named minion container, as a job for run_jobs'
+        display(self.verbose, "Deleting minion container " + instance_name)
+        if is_running(instance_name):
+            stop_container(instance_name)
+        delete_container(instance_name)
+        self.state.remove_instance(instance_name)
 
     def stop_minion_container(self, instance_number):
         'stop the specified salt minion container'
@@ -534,28 +2426,16 @@ class SaltCluster(object):
         if is_running(instance_name):
             stop_container(instance_name)
 
-    def do_stop_jobs(self):
-        """
-        get jobs off the queue (a minion
-        instance number) and stop the specified
-        container until another thread tells me I
-        am done (by setting the stop_completed var)
-        """
-        while not self.stop_completed:
-            try:
-                i = self.queue.get(True, 1)
-            except Queue.Empty:
-                continue
-
-            display(self.verbose, "Stopping salt minion container "
-                    + str(i) + "...")
-            try:
-                self.stop_minion_container(i)
-            except Exception:
-                sys.stderr.write("problem stopping container " +
-                                 str(i) + ", continuing\n")
-            self.queue.task_done()
+    def do_stop_job(self, instance_number):
+        'stop the specified minion container, as a job for run_jobs'
+        display(self.verbose, "Stopping salt minion container "
+                + str(instance_number) + "...")
+        self.stop_minion_container(instance_number)
+        self.state.update_instance(self.get_salt_minion_name(instance_number),
+                                   instance=instance_number, phase='stopped',
+                                   error=None)
 
+    @PROFILER.timed('stop', phase=True)
     def stop_cluster(self, instance_no=None):
         """
         stop the cluster of salt containers,
@@ -563,80 +2443,81 @@ class SaltCluster(object):
         (I wonder if we should do this the other way around
         now that I think about it)
         """
+        self.invalidate_caches()
         # because we give the docker stop command several seconds to
         # complete and we are impatient, run these in parallel
         # in batches
+        self.sync_state()
         display(self.verbose, "Stopping salt master container...")
         self.master.stop_container()
+        self.state.update_master(phase='stopped')
 
-        self.stop_completed = False
-        self.queue = Queue.Queue()
-        if instance_no:
-            num_threads = 1
-        else:
-            # this was 20 but make it 1 for right now, 0.7.5 possible bug?
-            num_threads = 1
-        threads = start_threads(num_threads, self.do_stop_jobs)
-
-        if instance_no:
-            todo = [instance_no]
-        else:
-            todo = range(1, self.minion_count + 1)
-        for i in todo:
-            self.queue.put_nowait(i)
+        todo = self.get_todo(instance_no)
 
-        # everything on the queue done?
-        self.queue.join()
+        failures = self.run_phase("stop", "stopping", todo, self.do_stop_job)
+        self.state.save()
+        return failures
 
-        # notify threads to go home, and wait for them to do so
-        self.stop_completed = True
-        for thr in threads:
-            thr.join()
+    def do_delete_job(self, instance_number):
+        'delete the specified minion container, as a job for run_jobs'
+        instance_name = self.get_salt_minion_name(instance_number)
+        if container_exists(instance_name):
+            display(self.verbose, "Deleting minion container " +
+                    str(instance_number))
+            delete_container(instance_name)
+        self.state.remove_instance(instance_name)
 
+    @PROFILER.timed('delete', phase=True)
     def delete_cluster(self, instance_no=None):
         """
         delete containers for this cluster
         """
-        if instance_no:
-            todo = [instance_no]
-        else:
-            todo = range(1, self.minion_count + 1)
-        for i in todo:
-            instance_name = self.get_salt_minion_name(i)
-            if container_exists(instance_name):
-                display(self.verbose, "Deleting minion container " + str(i))
-                try:
-                    delete_container(instance_name)
-                except Exception:
-                    traceback.print_exc(file=sys.stderr)
-                    traceback.print_stack(file=sys.stderr)
-                    sys.stderr.write("Failed to delete container " +
-                                     str(i) + "... continuing\n")
-
-        if not instance_no:
+        self.invalidate_caches()
+        todo = self.get_todo(instance_no)
+        failures = self.run_phase("delete", "deleting", todo,
+                                  self.do_delete_job)
+
+        if instance_no is None:
             if container_exists(self.master.hostname):
                 display(self.verbose, "Deleting salt master container")
                 delete_container(self.master.hostname)
+            self.state.set('master', {})
+            self.master.fingerprint = None
+        self.state.save()
+        return failures
 
+    @PROFILER.timed('purge', phase=True)
     def purge_cluster(self, instance_no=None):
         """
         remove all images connected
         with this cluster, if no instance number is supplied
         """
+        IMAGES.invalidate()
         if instance_no is None:
 
             # NOTE that there are no intermediate images (check this!)
             for entry in self.minion_tags:
-                if image_exists(self.repo, entry):
+                image_id = get_image_id(self.repo, entry)
+                if image_id:
                     display(self.verbose,
                             "Deleting minion image %s" %
                             get_image_name(self.repo, entry))
-                    delete_image(get_image_id(self.repo, entry))
+                    delete_image(image_id)
+                self.forget_image(get_image_name(self.repo, entry))
 
-        if image_exists(self.repo, self.master.tag):
+        image_id = get_image_id(self.repo, self.master.tag)
+        if image_id:
             display(self.verbose, "Deleting master image %s" %
                     get_image_name(self.repo, self.master.tag))
-            delete_image(get_image_id(self.repo, self.master.tag))
+            delete_image(image_id)
+        self.forget_image(get_image_name(self.repo, self.master.tag))
+        self.state.save()
+
+    def forget_image(self, image_name):
+        'drop the image from the saved state'
+        images = self.state.get('images')
+        images.pop(image_name, None)
+        self.state.set('images', images)
 
     def gen_dockerfile_from_tag(self, tag):
         """
@@ -645,7 +2526,8 @@ class SaltCluster(object):
         package source (git or deb) desired.
         """
         deb_path = "salt/debs"
-        dockerfile_contents = "FROM %s:{image}base\n" % self.repo
+        dockerfile_contents = "FROM %s\n" % get_base_image_name(self.repo,
+                                                               "{image}")
         if tag['package'] == 'git':
             dockerfile_contents += """
 RUN cd /src/salt && git fetch --tags && git checkout {version} && python ./setup.py install --force
@@ -698,12 +2580,16 @@ CMD python /usr/sbin/pupaas.py && /usr/sbin/sshd -D
                 return entry
         return None
 
+    @PROFILER.timed('create', phase=True)
     def create_cluster(self, instance_no=None):
         """
         create the salt master image and container
         and the salt minion image and containers,
         deleting pre-existing ones if requested
         """
+        self.invalidate_caches()
+        IMAGES.invalidate()
+        self.sync_state()
         if instance_no is None:
             if self.docker_force:
                 display(self.verbose, "Deleting cluster if it exists...")
@@ -713,41 +2599,206 @@ CMD python /usr/sbin/pupaas.py && /usr/sbin/sshd -D
             if self.docker_force:
                 display(self.verbose, "Deleting instance if it exists...")
                 self.delete_cluster(instance_no)
-            tags_todo = [self.get_tag(instance_no)]
-
-        # don't build the same image twice
-        created_images = []
-        for entry in tags_todo:
-            # don't build the same image twice
-            if get_image_name(self.repo, entry) not in created_images:
-
-                if self.docker_force or not image_exists(self.repo, entry):
-                    minion_image_name = get_image_name(self.repo, entry)
-                    display(self.verbose, "Building image for minion, %s" %
-                            minion_image_name)
-                    dockerfile_contents = self.gen_dockerfile_from_tag(entry)
-                    self.docker.build(dockerfile_contents, self.repo, entry)
-                    created_images.append(minion_image_name)
+            tags_todo = []
+            for number in self.get_todo(instance_no):
+                if self.get_tag(number) not in tags_todo:
+                    tags_todo.append(self.get_tag(number))
+
+        # build what's needed: base images first, then salt
+        # version images on top of them; each image is
+        # only built once, however many tags want it
+        with self.build_lock:
+            graph = BuildGraph()
+            for entry in tags_todo:
+                self.add_image_build(graph, entry, "minion")
+            self.add_image_build(graph, self.master.tag, "master")
+            failures = graph.run(min(self.get_concurrency(), MAX_BUILD_JOBS))
+        self.report_failures("building", failures, "image")
+        if failures:
+            self.add_summary("build", len(graph.order), failures)
+            raise DockerError("Failed to build images for cluster")
+        images = self.state.get('images')
+        for entry in tags_todo + [self.master.tag]:
+            images[get_image_name(self.repo, entry)] = get_image_id(self.repo,
+                                                                    entry)
+        self.state.set('images', images)
+        self.state.set('minion_tags', self.minion_tags_text)
+        self.state.set('minion_prefix', self.saltminion_prefix)
+        if self.dns:
+            self.state.set('dns', self.dns)
 
         master_image_name = get_image_name(self.repo, self.master.tag)
-        if self.docker_force or not image_exists(self.repo, self.master.tag):
-            display(self.verbose, "Building image for master, %s" %
-                    master_image_name)
-            dockerfile_contents = self.gen_dockerfile_from_tag(self.master.tag)
-            self.docker.build(dockerfile_contents, self.repo, self.master.tag)
-            created_images.append(get_image_name(self.repo, self.master.tag))
         if self.docker_force or not container_exists(self.master.hostname):
             display(self.verbose, "Creating salt master container %s" %
                     self.master.hostname)
-            self.docker.create(master_image_name, self.master.hostname)
+            self.docker.create(master_image_name, self.master.hostname,
+                               self.get_create_binds(), self.dns)
+            self.state.set('master', {
+                'id': INVENTORY.lookup(self.master.hostname)['id'],
+                'phase': 'created'})
+            self.master.fingerprint = None
+            if self.preseed_master:
+                display(self.verbose, "Adding keys to salt master container")
+                keys = self.get_master_keys()
+                put_files(self.master.hostname, '/etc',
+                          {'salt/pki/master/master.pem': keys['pem'],
+                           'salt/pki/master/master.pub': keys['pub']},
+                          {'salt/pki/master/master.pem': 0400})
+
+        to_do = self.get_todo(instance_no)
+        self.created_minions = []
+        failures = self.run_phase("create", "creating", to_do,
+                                  self.create_minion_container)
+        if self.preseed_minions and self.created_minions:
+            failures.extend(self.preseed_minion_keys(self.created_minions))
+        self.state.save()
+        return failures
+
+    def preseed_minion_keys(self, minion_names):
+        """
+        generate keys for the specified minion containers,
+        put each private key into its minion and all the
+        public keys into the master as accepted keys, so
+        the minions don't all go through key acceptance
+        with the master at once when they start
+        """
+        display(self.verbose, "Adding keys to salt minion containers...")
+        METADATA.prefetch(minion_names)
+        self.minion_pub_keys = {}
+        failures = self.run_phase("add keys", "adding keys to", minion_names,
+                                  self.do_minion_keys_job)
+        if self.minion_pub_keys:
+            display(self.verbose, "Adding minion keys to salt master...")
+            put_files(self.master.hostname, '/etc', self.minion_pub_keys)
+        return failures
+
+    def do_minion_keys_job(self, minion_name):
+        """
+        generate (or reuse) the keys for the minion, copy them
+        into its container and save the public key for the master
+        """
+        minion_id = METADATA.get(minion_name)['hostname']
+        key_dir = os.path.join(self.state_dir, self.master.hostname,
+                               'pki', 'minions', minion_id)
+        keys = get_keys(key_dir, 'minion', MINION_KEY_SIZE)
+        # the pki directories may not exist until salt first runs
+        put_files(minion_name, '/etc',
+                  {'salt/pki/minion/minion.pem': keys['pem'],
+                   'salt/pki/minion/minion.pub': keys['pub']},
+                  {'salt/pki/minion/minion.pem': 0400})
+        with self.lock:
+            self.minion_pub_keys['salt/pki/master/minions/' +
+                                 minion_id] = keys['pub']
+
+    def add_image_build(self, graph, tag, role):
+        """
+        add a build of the image for the specified tag to
+        the build graph if it needs building, along with
+        a build of its base image if that is missing or
+        out of date
+        """
+        image_name = get_image_name(self.repo, tag)
+        deps = []
+        base_image_name = get_base_image_name(self.repo, tag['image'])
+        if (base_image_name in graph.builds or
+                self.base_image_needs_build(tag['image'])):
+            graph.add(base_image_name, self.build_base_image, [tag['image']])
+            deps.append(base_image_name)
+        elif not self.docker_force and not self.image_needs_build(tag):
+            return
+        graph.add(image_name, self.build_image, [tag, role], deps)
 
-        if instance_no is None:
-            to_do = range(1, self.minion_count + 1)
-        else:
-            to_do = [instance_no]
+    def base_image_needs_build(self, distro):
+        """
+        check whether the base image for the distro is missing,
+        or was built from a different dockerfile or files than
+        we have now; images without the build hash label were
+        built before we kept track, so we can't tell what is
+        in them and they are rebuilt too
+        """
+        base_image_name = get_base_image_name(self.repo, distro)
+        if IMAGES.get_id(base_image_name) is None:
+            return True
+        image_hash = IMAGES.get_labels(base_image_name).get(HASH_LABEL)
+        if distro not in self.base_hashes:
+            proc = subprocess.Popen([sys.executable, "generate_dockerfile.py",
+                                     "-d", distro, "--hash"], cwd=SALT_DIR,
+                                    stdout=subprocess.PIPE)
+            output, _ = proc.communicate()
+            if proc.returncode:
+                display(self.verbose, "Can't check whether %s is up to date"
+                        % base_image_name)
+                self.base_hashes[distro] = None
+            else:
+                self.base_hashes[distro] = output.strip()
+        if self.base_hashes[distro] is None:
+            return False
+        if self.base_hashes[distro] != image_hash:
+            display(self.verbose, "Image %s is out of date" % base_image_name)
+            return True
+        return False
+
+    def image_needs_build(self, tag):
+        """
+        check whether the image for the tag is missing, or
+        was built from a different dockerfile, base image
+        or salt commit than it would be now
+        """
+        image_name = get_image_name(self.repo, tag)
+        if not image_exists(self.repo, tag):
+            return True
+        if (tag['package'] == 'git' and
+                get_git_commit(tag['version'],
+                               self.get_git_commits_path()) is None):
+            display(self.verbose, "Can't tell whether %s is up to date, "
+                    "keeping it" % image_name)
+            return False
+        image_hash = IMAGES.get_labels(image_name).get(HASH_LABEL)
+        if image_hash != self.get_build_hash(tag,
+                                             self.gen_dockerfile_from_tag(tag)):
+            display(self.verbose, "Image %s is out of date" % image_name)
+            return True
+        return False
 
-        for instance_no in to_do:
-            self.create_minion_container(instance_no)
+    def get_build_hash(self, tag, dockerfile_contents):
+        """
+        return a hash of everything that goes into the image
+        for the specified tag: the dockerfile contents, the
+        base image (which has the deb packages in it) and,
+        for git versions, the commit the version refers to
+        (or the version itself if we have never been able
+        to look that up)
+        """
+        build_hash = hashlib.sha1(dockerfile_contents)
+        build_hash.update(str(IMAGES.get_id(
+            get_base_image_name(self.repo, tag['image']))))
+        if tag['package'] == 'git':
+            commit = get_git_commit(tag['version'],
+                                    self.get_git_commits_path())
+            build_hash.update(commit or tag['version'])
+        return build_hash.hexdigest()
+
+    def get_git_commits_path(self):
+        'return the path of the file of salt git commits we have looked up'
+        return os.path.join(self.state_dir, GIT_COMMITS_FILE)
+
+    def build_base_image(self, distro):
+        'build the base image for the specified distro'
+        display(self.verbose, "Building base image, %s" %
+                get_base_image_name(self.repo, distro))
+        self.docker.build_base(self.repo, distro)
+
+    def build_image(self, tag, role):
+        """
+        build the image for the specified tag, labelled
+        with the hash of what went into it
+        """
+        display(self.verbose, "Building image for %s, %s" %
+                (role, get_image_name(self.repo, tag)))
+        dockerfile_contents = self.gen_dockerfile_from_tag(tag)
+        dockerfile_contents += "LABEL %s=%s\n" % (
+            HASH_LABEL, self.get_build_hash(tag, dockerfile_contents))
+        self.docker.build(dockerfile_contents, self.repo, tag)
 
     def create_minion_container(self, instance_no):
         """
@@ -761,8 +2812,229 @@ CMD python /usr/sbin/pupaas.py && /usr/sbin/sshd -D
             display(self.verbose, "Creating salt minion container " + str(instance_no))
             self.docker.create(get_image_name(self.repo,
                                               self.get_tag(instance_no)),
-                               minion_instance_name)
+                               minion_instance_name, self.get_create_binds(),
+                               self.dns)
+            with self.lock:
+                self.created_minions.append(minion_instance_name)
+            self.state.remove_instance(minion_instance_name)
+            self.state.update_instance(
+                minion_instance_name, instance=instance_no, phase='created',
+                id=INVENTORY.lookup(minion_instance_name)['id'])
+
+
+class VersionMatrix(object):
+    """
+    stand up a cluster for each combination of master tag and
+    set of minion tags, each with its own container name
+    prefixes so they can run side by side, run the same load
+    test on each, tear them down again and compare how they
+    did: whether everything configured and answered, how
+    long each step took and the load test numbers
+    """
+    def __init__(self, master_tags, minion_tag_sets, make_cluster,
+                 load, clusters='auto', concurrency='auto', verbose=False):
+        self.cells = [(master_tag, minion_tags)
+                      for master_tag in master_tags
+                      for minion_tags in minion_tag_sets]
+        self.make_cluster = make_cluster
+        self.load = load
+        self.clusters = clusters
+        self.concurrency = concurrency
+        self.cluster_concurrency = concurrency
+        self.verbose = verbose
+        self.results = [None] * len(self.cells)
+        # clusters may share images, which must only be built once
+        self.build_lock = threading.Lock()
+
+    def get_parallel(self):
+        """
+        return the number of clusters to run at once, and
+        the number of instances each of them may work on
+        at once; for 'auto' the clusters get as many of the
+        biggest cluster as there is room for going by the
+        host's resources, and the instances get an equal
+        share of what the host has room for
+        """
+        if self.concurrency == 'auto' or self.clusters == 'auto':
+            host_concurrency = get_auto_concurrency()
+        if self.clusters != 'auto':
+            parallel = min(self.clusters, len(self.cells))
+        else:
+            biggest = max(
+                1 + sum(int(get_salt_tag_from_text(entry)['minions'])
+                        for entry in minion_tags.split(","))
+                for _, minion_tags in self.cells)
+            parallel = max(1, min(host_concurrency / biggest,
+                                  len(self.cells)))
+        if self.concurrency != 'auto':
+            return parallel, self.concurrency
+        return parallel, max(1, host_concurrency / parallel)
+
+    def run(self):
+        'run every combination, some at once, and return the results'
+        parallel, self.cluster_concurrency = self.get_parallel()
+        display(self.verbose, "Running %d clusters of %d at once, "
+                "working on %d instances at once in each" % (
+                    parallel, len(self.cells), self.cluster_concurrency))
+        run_jobs(range(len(self.cells)), self.run_cell, parallel)
+        return self.results
+
+    def run_cell(self, index):
+        """
+        create, start, configure and load test the cluster for
+        one combination, then stop and delete it, keeping the
+        step times, the phase summary and the load test report
+        """
+        master_tag, minion_tags = self.cells[index]
+        result = {'master': master_tag, 'minions': minion_tags,
+                  'times': {}, 'error': None, 'benchmark': None,
+                  'phases': []}
+        self.results[index] = result
+        cluster = None
+        try:
+            cluster = self.make_cluster(index + 1, master_tag, minion_tags,
+                                        self.cluster_concurrency)
+            cluster.build_lock = self.build_lock
+            self.run_step(result, 'create', cluster.create_cluster)
+            self.run_step(result, 'start', cluster.start_cluster)
+            self.run_step(result, 'configure', cluster.configure_cluster)
+            self.run_step(result, 'benchmark',
+                          lambda: cluster.benchmark_cluster(self.load))
+        except Exception as ex:
+            result['error'] = "%s: %s" % (ex.__class__.__name__, ex)
+        if cluster is not None:
+            # delete even if stop fails, or the containers are left behind
+            for step, method in [('stop', cluster.stop_cluster),
+                                 ('delete', cluster.delete_cluster)]:
+                try:
+                    self.run_step(result, step, method)
+                except Exception as ex:
+                    result['error'] = result['error'] or "%s: %s" % (
+                        ex.__class__.__name__, ex)
+            result['phases'] = cluster.summary
+            for phase in cluster.summary:
+                if phase['phase'] == 'benchmark':
+                    result['benchmark'] = phase['benchmark']
+        result['failed'] = sum(len(phase['failed'])
+                               for phase in result['phases'])
+        if result['error']:
+            result['status'] = 'error'
+        elif result['failed']:
+            result['status'] = 'failed'
+        else:
+            result['status'] = 'ok'
+        display(self.verbose, "Cluster %s with %s: %s" % (
+            master_tag, minion_tags, result['status']))
+
+    def run_step(self, result, step, method):
+        'call the method for a step and note how long it took'
+        display(self.verbose, "Matrix %s %s with %s" % (
+            step, result['master'], result['minions']))
+        start = time.time()
+        try:
+            method()
+        finally:
+            result['times'][step] = time.time() - start
+
+
+def get_salt_start_manifest(service, conffile_args=""):
+    """
+    return a puppet manifest that writes the config file
+    for the salt service ('master' or 'minion') and starts
+    the service, in a single puppet run; the service only
+    requires the config file instead of subscribing to it,
+    so we don't hit puppet bug 7165 (ensure running causes
+    start, refresh from file update causes restart, fixed
+    in puppet 3.2) -- salt doesn't do well with the quick
+    start-restart
+    """
+    return ("import 'salt.pp'\n"
+            "class { 'salt::%(service)s::conffile': %(args)s }\n"
+            "service { 'salt-%(service)s':\n"
+            "        provider => 'base',\n"
+            "        ensure => 'running',\n"
+            "        enable => false,\n"
+            "        require => Class['salt::%(service)s::conffile'],\n"
+            "        start => '/etc/init.d/salt-%(service)s start',\n"
+            "        stop => '/etc/init.d/salt-%(service)s stop',\n"
+            "        restart => '/etc/init.d/salt-%(service)s restart',\n"
+            "        status => '/etc/init.d/salt-%(service)s status'\n"
+            "}\n" % {'service': service, 'args': conffile_args})
+
+def render_minion_config(master_name, minion_id, fingerprint):
+    """
+    fill in the salt minion config template the way
+    puppet would, with the master name, the minion id
+    (the container's hostname) and the master fingerprint
+    """
+    values = {'::salt::minion::conffile::salt_master': master_name,
+              '::hostname': minion_id,
+              '::salt::minion::conffile::master_fingerprint': fingerprint}
+    with open(SALT_MINION_CONFIG_TEMPLATE, 'r') as template:
+        return re.sub(r"<%=\s*scope\.lookupvar\('([^']+)'\)\s*%>",
+                      lambda match: values[match.group(1)], template.read())
+
+def generate_keypair(bits):
+    """
+    generate an rsa keypair with openssl, returning the
+    private key in the traditional (pkcs#1) pem format
+    and the public key, both the way salt writes them
+    """
+    proc = subprocess.Popen(['openssl', 'genrsa', str(bits)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    private_key, errors = proc.communicate()
+    if proc.returncode:
+        raise DockerError("Failed to generate key: " + errors)
+    if "BEGIN PRIVATE KEY" in private_key:
+        # newer openssl writes pkcs#8 unless told otherwise
+        private_key = run_openssl(['rsa', '-traditional'], private_key)
+    public_key = run_openssl(['rsa', '-pubout'], private_key)
+    return private_key, public_key
+
+def run_openssl(args, key):
+    'feed the key to the openssl command with the given args, return output'
+    proc = subprocess.Popen(['openssl'] + args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = proc.communicate(key)
+    if proc.returncode:
+        raise DockerError("Failed to run openssl %s: %s" %
+                          (" ".join(args), errors))
+    return output
+
+def get_pem_fingerprint(public_key):
+    """
+    return the fingerprint salt-key -f shows for the public
+    key: the md5sum of the lines between the pem header
+    and footer, as colon separated pairs of hex digits
+    """
+    key = "".join(public_key.splitlines(True)[1:-1])
+    digest = hashlib.md5(key).hexdigest()
+    return ":".join(digest[i:i + 2] for i in range(0, len(digest), 2))
 
+def get_keys(key_dir, name, bits):
+    """
+    return the keypair <name>.pem, <name>.pub from the
+    key directory along with the public key fingerprint,
+    generating the keys and saving them there first if
+    they don't exist yet
+    """
+    pem_path = os.path.join(key_dir, name + '.pem')
+    pub_path = os.path.join(key_dir, name + '.pub')
+    if not os.path.exists(pem_path) or not os.path.exists(pub_path):
+        private_key, public_key = generate_keypair(bits)
+        if not os.path.exists(key_dir):
+            os.makedirs(key_dir, 0700)
+        fdesc = os.open(pem_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0400)
+        with os.fdopen(fdesc, 'w') as pem:
+            pem.write(private_key)
+        with open(pub_path, 'w') as pub:
+            pub.write(public_key)
+    with open(pem_path, 'r') as pem:
+        private_key = pem.read()
+    with open(pub_path, 'r') as pub:
+        public_key = pub.read()
+    return {'pem': private_key, 'pub': public_key,
+            'fingerprint': get_pem_fingerprint(public_key)}
 
 def sanitize(text):
     'make text safe for use as container name'
@@ -773,17 +3045,13 @@ def get_image_id(image_repo, image_tag):
     given the image repo and tag (where
     tag cotains info about the ubuntu version, salt
     version and package type of the image),
-    retrieve the image id from docker via the api
+    retrieve the image id from the image catalog
     and return it
     """
-    image_name = get_image_name(image_repo, image_tag)
-    url = "/images/json"
-    output = get_url(url)
-    for entry in output:
-        if (entry['Id'].startswith(image_name) or
-            image_name in entry['RepoTags']):
-            return entry['Id']
-    return False
+    image_id = IMAGES.get_id(get_image_name(image_repo, image_tag))
+    if image_id is None:
+        return False
+    return image_id
 
 def display(verbose, message):
     """
@@ -794,6 +3062,7 @@ def display(verbose, message):
     if verbose:
         print message
 
+@PROFILER.timed('update_etc_hosts')
 def update_etc_hosts(instance_name, hosts_ips):
     """
     for the given instance name, update
@@ -825,6 +3094,66 @@ def update_etc_hosts(instance_name, hosts_ips):
         hosts.write(contents)
 
 
+@PROFILER.timed('write_hosts_file')
+def write_hosts_file(hosts_file, hosts_ips):
+    """
+    write the cluster hosts file with localhost entries and
+    the specified hosts and ip addresses; the whole file is
+    rendered first and then written with one write, in place,
+    since containers bind mount the file itself (a renamed
+    replacement would not be seen by them)
+    """
+    salt_entries = ["%s   %s" % (hosts_ips[name], name)
+                    for name in sorted(hosts_ips)]
+    contents = "\n".join(["127.0.0.1   localhost",
+                          "::1   localhost ip6-localhost ip6-loopback",
+                          "# saltcluster additions"] + salt_entries) + "\n"
+    mode = 'r+b' if os.path.exists(hosts_file) else 'wb'
+    with open(hosts_file, mode) as hosts:
+        hosts.write(contents)
+        hosts.truncate()
+
+def get_hosts_bind(inspect_output):
+    """
+    given the inspect output for a container, return the
+    host path bind mounted as its /etc/hosts, if any
+    """
+    for bind in (inspect_output.get('HostConfig') or {}).get('Binds') or []:
+        fields = bind.split(':')
+        if len(fields) > 1 and fields[1] == '/etc/hosts':
+            return fields[0]
+    return None
+
+def get_upstream_nameserver(own_address=None):
+    """
+    return the first nameserver in the host's resolv.conf
+    that is not us, or None
+    """
+    try:
+        with open('/etc/resolv.conf', 'r') as resolv:
+            for line in resolv:
+                fields = line.split()
+                if (len(fields) > 1 and fields[0] == 'nameserver' and
+                        fields[1] != own_address and is_ip(fields[1])):
+                    return fields[1]
+    except IOError:
+        pass
+    return None
+
+def get_search_domains():
+    'return the search domains in the host\'s resolv.conf'
+    domains = []
+    try:
+        with open('/etc/resolv.conf', 'r') as resolv:
+            for line in resolv:
+                fields = line.split()
+                if fields and fields[0] in ['search', 'domain']:
+                    domains.extend(field.rstrip('.').lower()
+                                   for field in fields[1:])
+    except IOError:
+        pass
+    return domains
+
 def start_container(instance_name):
     """
     start a container via the docker api
@@ -840,6 +3169,8 @@ def start_container(instance_name):
 
     config_string = json.dumps(config)
     get_url(url, "POST", config_string)
+    INVENTORY.set_running(instance_name, True)
+    METADATA.invalidate(instance_name)
 
 def is_running(instance_name):
     'check if the specified container is running'
@@ -848,7 +3179,8 @@ def is_running(instance_name):
 def start_threads(count, target):
     """
     start the specified number of threads
-    to execute the specified function ('target')
+    to execute the specified function ('target');
+    see set_thread_stack_size for keeping them cheap
     """
     threads = []
     for _ in range(1, count+1):
@@ -858,6 +3190,266 @@ def start_threads(count, target):
         threads.append(thr)
     return threads
 
+def set_thread_stack_size():
+    """
+    our threads spend their time waiting on sockets,
+    so give them a small stack, which keeps hundreds
+    of them cheap; the setting is for the whole process,
+    so this is done once at startup rather than around
+    each batch of threads
+    """
+    threading.stack_size(WORKER_STACK_SIZE)
+
+def is_connection_dropped(http_conn):
+    """
+    check whether an idle connection has been closed
+    by the server: its socket then reads as ready
+    (with eof) although we haven't asked for anything
+    """
+    if http_conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([http_conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+def is_listening(host, port):
+    'check if something on the host accepts connections on the port'
+    try:
+        sock = socket.create_connection((host, port), timeout=2)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+def wait_until(check, description, timeout):
+    """
+    call check() until it returns something true, and return
+    that; between tries, back off exponentially with some
+    jitter so that many waiters don't all retry at once;
+    errors from check() count as not ready yet.
+    raise NotReadyError if we are still waiting after
+    'timeout' seconds
+    """
+    deadline = time.time() + timeout
+    delay = READY_INITIAL_DELAY
+    while True:
+        error = None
+        try:
+            result = check()
+            if result:
+                return result
+        except Exception as ex:
+            error = ex
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            if error is not None:
+                description = "%s (%s)" % (description, error)
+            raise NotReadyError("Timed out waiting for " + description)
+        time.sleep(min(delay * random.uniform(0.5, 1.5), remaining))
+        delay = min(delay * 2, READY_MAX_DELAY)
+
+def get_percentile(sorted_values, percent):
+    'return the given percentile of a sorted non-empty list of values'
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def get_load_report(result, minion_ids):
+    """
+    given the results printed by salt-load.py and the ids
+    of the minions that should have answered, return the
+    return latency percentiles, the returns missing (in all
+    and per minion) and the jobs and returns per second
+    """
+    latencies = []
+    missing = collections.Counter()
+    errors = []
+    for job in result['jobs']:
+        if job['error']:
+            errors.append("job %d: %s" % (job['job'], job['error']))
+        for minion_id in minion_ids:
+            if minion_id in job['returns']:
+                latencies.append(job['returns'][minion_id])
+            else:
+                missing[minion_id] += 1
+    latencies.sort()
+    elapsed = result['elapsed']
+    report = {'jobs': len(result['jobs']), 'minions': len(minion_ids),
+              'elapsed': elapsed,
+              'jobs_per_second': len(result['jobs']) / elapsed,
+              'returns': len(latencies),
+              'returns_per_second': len(latencies) / elapsed,
+              'missing_returns': sum(missing.values()),
+              'missing_by_minion': sorted(missing.items()),
+              'errors': errors}
+    if latencies:
+        report.update({'p50': get_percentile(latencies, 50),
+                       'p95': get_percentile(latencies, 95),
+                       'p99': get_percentile(latencies, 99),
+                       'max': latencies[-1]})
+    return report
+
+def get_load_summary(report):
+    'return a human readable summary of a load test report'
+    lines = ["%d jobs to %d minions in %.3fs: %.2f jobs/s, %.2f returns/s" % (
+        report['jobs'], report['minions'], report['elapsed'],
+        report['jobs_per_second'], report['returns_per_second'])]
+    if report['returns']:
+        lines.append("return latency: p50 %.3fs p95 %.3fs p99 %.3fs "
+                     "max %.3fs" % (report['p50'], report['p95'],
+                                    report['p99'], report['max']))
+    lines.append("missing returns: %d of %d" % (
+        report['missing_returns'], report['jobs'] * report['minions']))
+    for error in report['errors'][:PROFILE_TOP]:
+        lines.append("error in " + error)
+    return "\n".join(lines)
+
+def get_latency_stats(latencies):
+    """
+    given a dict of lists of latencies, return the count
+    and percentiles for each list
+    """
+    stats = {}
+    for name, values in latencies.items():
+        values = sorted(round(value, 4) for value in values)
+        stats[name] = {'count': len(values),
+                       'p50': get_percentile(values, 50),
+                       'p95': get_percentile(values, 95),
+                       'p99': get_percentile(values, 99),
+                       'max': values[-1]}
+    return stats
+
+def get_call_type(url):
+    """
+    reduce a docker api url to the kind of call it is,
+    leaving out container and image names and the query,
+    e.g. /containers/<name>/json becomes /containers/*/json;
+    image names may have slashes in them (ariel/salt:...),
+    so for images everything up to the action goes
+    """
+    parts = url.split('?')[0].split('/')
+    if len(parts) < 3 or parts[2] in ['json', 'create', 'search', 'load',
+                                      'prune']:
+        # not about any one container or image
+        return '/'.join(parts)
+    if parts[1] == 'images':
+        if len(parts) > 3 and parts[-1] in ['json', 'history', 'push',
+                                            'tag', 'get']:
+            return '/'.join(parts[:2] + ['*', parts[-1]])
+        return '/'.join(parts[:2] + ['*'])
+    return '/'.join(parts[:2] + ['*'] + parts[3:])
+
+def get_free_memory():
+    """
+    return the memory available for new work in MB,
+    as reported by /proc/meminfo, or None if we
+    can't tell
+    """
+    fields = {}
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                name, _, value = line.partition(':')
+                fields[name] = int(value.split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    if 'MemAvailable' in fields:
+        return fields['MemAvailable'] / 1024
+    return (fields.get('MemFree', 0) + fields.get('Buffers', 0) +
+            fields.get('Cached', 0)) / 1024
+
+def get_auto_concurrency():
+    """
+    pick how many instances to work on at once from
+    the number of processors not already busy (going
+    by the load average) and the free memory
+    """
+    cpus = multiprocessing.cpu_count()
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0
+    # jobs mostly sit waiting on docker or puppet,
+    # so allow several per idle processor
+    concurrency = int(max(cpus - load, 1) * JOBS_PER_CPU)
+    free_mem = get_free_memory()
+    if free_mem is not None:
+        concurrency = min(concurrency, free_mem / MB_PER_JOB)
+    return max(1, min(concurrency, MAX_AUTO_JOBS))
+
+def get_concurrency_from_text(text):
+    """
+    convert the --jobs argument into a concurrency
+    level, or 'auto'; return None if it's bad
+    """
+    if text == 'auto':
+        return text
+    if not text.isdigit() or not int(text):
+        return None
+    return int(text)
+
+def run_jobs(todo, target, concurrency):
+    """
+    call target(item) for each item in todo, with at
+    most 'concurrency' of them running at once, and
+    return a list of the items that failed along with
+    the error for each
+    """
+    failures = []
+    lock = threading.Lock()
+    jobs = Queue.Queue()
+    for item in todo:
+        jobs.put_nowait(item)
+
+    def do_jobs():
+        'run jobs from the queue until it is empty'
+        while True:
+            try:
+                item = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                target(item)
+            except Exception as ex:
+                with lock:
+                    failures.append({'instance': item,
+                                     'error': ex.__class__.__name__,
+                                     'message': str(ex),
+                                     'traceback': traceback.format_exc()})
+
+    num_threads = min(concurrency, jobs.qsize())
+    if num_threads <= 1:
+        do_jobs()
+    else:
+        for thr in start_threads(num_threads, do_jobs):
+            thr.join()
+    failures.sort(key=lambda failure: failure['instance'])
+    return failures
+
+def get_minion_name(prefix, instance_number, tag):
+    """
+    return the container name for the minion with the
+    given instance number and tag, like
+    minion-25-precise-v0.15.0-git
+    """
+    return "-".join([prefix, str(instance_number), tag['image'],
+                     sanitize(tag['version']), tag['package']])
+
+def get_minion_names(prefix, minion_tags_text):
+    """
+    return the container names of all the minions
+    described by the minion tags text
+    """
+    names = []
+    number = 0
+    for entry in minion_tags_text.split(","):
+        tag = get_salt_tag_from_text(entry)
+        for _ in range(int(tag['minions'])):
+            number += 1
+            names.append(get_minion_name(prefix, number, tag))
+    return names
+
 def get_salt_tag_from_text(text):
     """
     convert count and version information for
@@ -877,17 +3469,12 @@ def container_exists(container_name, check_all=True):
     check if the specified container exists;
     if check_all is False then only running
     containers will be checked to see if it
-    is among them
+    is among them; answered from the container
+    inventory snapshot
     """
-    url = "/containers/json"
     if check_all:
-        url = url + "?all=1"
-    output = get_url(url)
-    for entry in output:
-        if (entry['Id'].startswith(container_name) or
-            container_name in [n[1:] for n in entry['Names']]):
-            return True
-    return False
+        return INVENTORY.exists(container_name)
+    return INVENTORY.is_running(container_name)
 
 def get_hosts_file(instance_name):
     """
@@ -896,11 +3483,8 @@ def get_hosts_file(instance_name):
     annoying docker is about allowing updates to this
     file (hint: it doesn't)
     """
-    url = "/containers/" + instance_name + "/json"
-    output = get_url(url)
-    result = output['HostsPath'].strip()
+    result = METADATA.get(instance_name)['hosts_path']
     if not result:
-        sys.stderr.write('got: ' + output + "\n")
         raise DockerError('Failed to get hosts file name for ' + instance_name)
     return result
 
@@ -916,16 +3500,180 @@ def stop_container(instance_name):
     # FIXME we should just shoot the processes on these containers
     url = "/containers/" + instance_name + "/stop?t=5"
     get_url(url, 'POST')
+    INVENTORY.set_running(instance_name, False)
+    METADATA.invalidate(instance_name)
+
+def exec_command(instance_name, command, timeout=None):
+    """
+    run a command in the specified (running) container
+    via docker exec, and return its exit code and
+    output (stdout and stderr together); if the command
+    may take longer than the usual docker api timeout,
+    give the number of seconds to wait for it
+    """
+    config = {"AttachStdin": False, "AttachStdout": True,
+              "AttachStderr": True, "Tty": False, "Cmd": command}
+    output = get_url("/containers/" + instance_name + "/exec", "POST",
+                     json.dumps(config))
+    exec_id = output['Id']
+    if timeout:
+        docker_api = DockerClient(DOCKER_API.socket_name, timeout, 0)
+    else:
+        docker_api = DOCKER_API
+    try:
+        status, data = docker_api.request("/exec/" + exec_id + "/start",
+                                          "POST", json.dumps({"Detach": False,
+                                                              "Tty": False}))
+    finally:
+        if timeout:
+            docker_api.close()
+    if status != 200:
+        if data:
+            sys.stderr.write(data + "\n")
+        raise IOError('failed to run ' + " ".join(command) + ' on ' +
+                      instance_name, " with response code " + str(status))
+    exit_code = get_url("/exec/" + exec_id + "/json")['ExitCode']
+    return exit_code, demux_docker_stream(data)
+
+def run_command(instance_name, command, timeout=None):
+    """
+    run a command in the specified container via docker
+    exec, raising DockerError if it fails
+    """
+    exit_code, output = exec_command(instance_name, command, timeout)
+    if exit_code:
+        if output:
+            sys.stderr.write(output)
+        raise DockerError("Failed to run %s on %s (exit code %s)" %
+                          (" ".join(command), instance_name, exit_code))
+    return output
+
+def start_exec_stream(instance_name, command):
+    """
+    start a command in the specified (running) container via
+    docker exec without waiting for it to finish; return the
+    connection and the response, from which the output can
+    be read as it comes with read_exec_frames
+    """
+    config = {"AttachStdin": False, "AttachStdout": True,
+              "AttachStderr": True, "Tty": False, "Cmd": command}
+    output = get_url("/containers/" + instance_name + "/exec", "POST",
+                     json.dumps(config))
+    http_conn = DOCKER_API.new_connection()
+    http_conn.request("POST", "/exec/" + output['Id'] + "/start",
+                      body=json.dumps({"Detach": False, "Tty": False}),
+                      headers={"User-Agent": "test-docker-api.py",
+                               "Content-Type": "application/json"})
+    response = http_conn.getresponse()
+    if response.status != 200:
+        data = response.read()
+        http_conn.close()
+        if data:
+            sys.stderr.write(data + "\n")
+        raise IOError('failed to run ' + " ".join(command) + ' on ' +
+                      instance_name, " with response code " +
+                      str(response.status))
+    return http_conn, response
+
+def read_exec_frames(response):
+    """
+    yield (stream type, payload) for each frame of exec
+    output as it arrives (see demux_docker_stream), until
+    the command finishes
+    """
+    while True:
+        header = read_exactly(response, 8)
+        if len(header) < 8:
+            return
+        length = struct.unpack('>I', header[4:8])[0]
+        payload = read_exactly(response, length)
+        yield ord(header[0]), payload
+        if len(payload) < length:
+            return
+
+def read_exactly(response, length):
+    'read length bytes from the response, or fewer if it ends first'
+    data = []
+    remaining = length
+    while remaining:
+        chunk = response.read(remaining)
+        if not chunk:
+            break
+        data.append(chunk)
+        remaining -= len(chunk)
+    return "".join(data)
+
+def demux_docker_stream(data):
+    """
+    docker sends stdout and stderr of a non-tty
+    exec as frames of an 8 byte header (stream type,
+    padding, payload length) followed by the payload;
+    return the payloads glued together
+    """
+    output = []
+    offset = 0
+    while offset + 8 <= len(data):
+        length = struct.unpack('>I', data[offset + 4:offset + 8])[0]
+        output.append(data[offset + 8:offset + 8 + length])
+        offset += 8 + length
+    return "".join(output)
+
+def put_files(instance_name, path, files, modes=None):
+    """
+    copy files into the specified container under the
+    given directory, via the docker api; files is a dict
+    of relative path names and contents, and any missing
+    directories on the way are created. files are mode
+    0644 unless modes (a dict of path names and modes)
+    says otherwise
+    """
+    archive = StringIO.StringIO()
+    tar = tarfile.open(fileobj=archive, mode='w')
+    dirs_done = set()
+    for name in sorted(files):
+        dirname = os.path.dirname(name)
+        parts = dirname.split('/') if dirname else []
+        for i in range(1, len(parts) + 1):
+            dirname = '/'.join(parts[:i])
+            if dirname not in dirs_done:
+                tarinfo = tarfile.TarInfo(dirname)
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = 0755
+                tarinfo.mtime = int(time.time())
+                tar.addfile(tarinfo)
+                dirs_done.add(dirname)
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(files[name])
+        tarinfo.mode = (modes or {}).get(name, 0644)
+        tarinfo.mtime = int(time.time())
+        tar.addfile(tarinfo, StringIO.StringIO(files[name]))
+    tar.close()
+    url = "/containers/%s/archive?path=%s" % (instance_name,
+                                               urllib.quote(path))
+    status, data = DOCKER_API.request(url, 'PUT', archive.getvalue(),
+                                      "application/x-tar")
+    if status != 200:
+        if data:
+            sys.stderr.write(data + "\n")
+        raise IOError('failed to put files in ' + path + ' on ' +
+                      instance_name, " with response code " + str(status))
 
 def delete_container(instance_name):
     'delete the specified container'
     url = "/containers/" + instance_name
     get_url(url, 'DELETE')
+    INVENTORY.remove(instance_name)
+    METADATA.invalidate(instance_name)
 
 def delete_image(instance_name):
     'delete the specified image'
     url = "/images/" + instance_name
-    get_url(url, 'DELETE')
+    try:
+        get_url(url, 'DELETE')
+    except Exception:
+        IMAGES.invalidate()
+        raise
+    IMAGES.remove(instance_name)
 
 def image_exists(image_repo, image_tag):
     """
@@ -933,14 +3681,156 @@ def image_exists(image_repo, image_tag):
     image tag (os version and salt package info),
     check if the image exists already
     """
-    image_name = get_image_name(image_repo, image_tag)
-    url = "/images/json"
-    output = get_url(url)
-    for entry in output:
-        if (entry['Id'].startswith(image_name) or
-            image_name in entry['RepoTags']):
-            return True
-    return False
+    return IMAGES.get_id(get_image_name(image_repo, image_tag)) is not None
+
+def read_chunks(response):
+    """
+    yield the body of an http response piece by piece as it
+    arrives; httplib only hands back as much as it was asked
+    for once it has it all, so we ask for small pieces
+    """
+    while True:
+        data = response.read(STREAM_READ_SIZE)
+        if not data:
+            break
+        yield data
+    response.close()
+
+def read_json_messages(chunks):
+    """
+    yield each of the json messages in a stream of utf-8
+    encoded pieces as soon as it is complete; a character
+    may be split across two pieces, so the decoding keeps
+    any partial character for the next piece
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u""
+    for chunk in chunks:
+        buf = (buf + utf8.decode(chunk)).lstrip()
+        while buf:
+            try:
+                message, end = decoder.raw_decode(buf)
+            except ValueError:
+                # incomplete, wait for the rest
+                break
+            buf = buf[end:].lstrip()
+            yield message
+    utf8.decode("", final=True)
+
+def make_build_context(dockerfile_contents, context_dir=None):
+    """
+    make a tar archive in memory holding the dockerfile
+    and, if context_dir is specified, the files in it
+    that the dockerfile adds to the image, so that other
+    changes there don't change the context
+    """
+    context = StringIO.StringIO()
+    tar = tarfile.open(fileobj=context, mode='w')
+    if context_dir:
+        for name in get_added_paths(dockerfile_contents):
+            tar.add(os.path.join(context_dir, name), arcname=name)
+    tarinfo = tarfile.TarInfo("Dockerfile")
+    tarinfo.size = len(dockerfile_contents)
+    tarinfo.mtime = int(time.time())
+    tar.addfile(tarinfo, StringIO.StringIO(dockerfile_contents))
+    tar.close()
+    return context.getvalue()
+
+def get_added_paths(dockerfile_contents):
+    """
+    return the local paths the ADD and COPY lines of the
+    dockerfile contents take from the build context
+    (urls are fetched by docker and so are left out)
+    """
+    paths = set()
+    for line in dockerfile_contents.splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0].upper() not in ['ADD', 'COPY']:
+            continue
+        for path in fields[1:-1]:
+            if '://' not in path:
+                paths.add(os.path.normpath(path))
+    return sorted(paths)
+
+def get_git_commit(version, cache_path):
+    """
+    return the commit in the salt git repo that the
+    specified tag or branch refers to, or None if we
+    can't look it up and have never been able to;
+    commits found are kept in the json file cache_path
+    and only looked up again after GIT_COMMIT_MAX_AGE
+    seconds, and if that fails we stick with the one
+    we had, so being offline doesn't change anything
+    """
+    global GIT_COMMITS
+    if len(version) == 40 and is_hex_digits(version):
+        return version
+    with GIT_COMMITS_LOCK:
+        if GIT_COMMITS is None:
+            GIT_COMMITS = read_git_commits(cache_path)
+        entry = GIT_COMMITS.get(version)
+    if entry and time.time() - entry['checked'] < GIT_COMMIT_MAX_AGE:
+        return entry['commit']
+    commit = lookup_git_commit(version)
+    if commit is None:
+        return entry['commit'] if entry else None
+    with GIT_COMMITS_LOCK:
+        GIT_COMMITS[version] = {'commit': commit, 'checked': time.time()}
+        contents = json.dumps(GIT_COMMITS, indent=1, sort_keys=True)
+    try:
+        dirname = os.path.dirname(cache_path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0700)
+        temp_path = "%s.%d.tmp" % (cache_path, threading.current_thread().ident)
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(contents)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as err:
+        sys.stderr.write("failed to save salt git commits to %s (%s)\n" %
+                         (cache_path, err))
+    return commit
+
+def read_git_commits(cache_path):
+    'return the salt git commits saved in cache_path, if any'
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def lookup_git_commit(version):
+    """
+    ask the salt git repo which commit the specified tag
+    or branch refers to right now; return None if we
+    can't find out
+    """
+    try:
+        proc = subprocess.Popen(['git', 'ls-remote', SALT_GIT_REPO,
+                                 version], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, _ = proc.communicate()
+    except OSError:
+        return None
+    if proc.returncode:
+        return None
+    refs = dict((line.split()[1], line.split()[0])
+                for line in output.splitlines() if len(line.split()) == 2)
+    # annotated tags show up with the commit as <tag>^{}
+    for ref in ['refs/tags/%s^{}' % version,
+                'refs/tags/%s' % version,
+                'refs/heads/%s' % version]:
+        if ref in refs:
+            return refs[ref]
+    return None
+
+def get_base_image_name(repo, distro):
+    """
+    given the image repo name and the distro (precise,
+    trusty, etc), return the name of the base image
+    the salt images for that distro are built from
+    """
+    return "%s:%sbase" % (repo, distro)
 
 def get_image_name(repo, tag):
     """
@@ -959,12 +3849,9 @@ def get_ip(instance_name):
     if it is running (if not, no ip address is
     assigned and an exception will be raised)
     """
-    url = "/containers/" + instance_name + "/json"
-    output = get_url(url)
-    result = output['NetworkSettings']['IPAddress'].strip()
+    result = METADATA.get(instance_name)['ip']
     if not result or not is_ip(result):
-        # fixme output is a dict not a string d'oh
-        sys.stderr.write('got: ' + output + "\n")
+        sys.stderr.write('got: ' + str(result) + "\n")
         raise DockerError('Failed to get ip of ' + instance_name)
     return result
 
@@ -987,32 +3874,9 @@ def is_ip(string):
 def get_url(url, method='GET', content=None):
     """
     retrieve a specified docker api url
-    via the local socket
+    via the local socket, reusing pooled connections
     """
-    try:
-        http_conn = LocalHTTPConnection("/var/run/docker.sock", timeout=20)
-    except Exception:
-        print "failed to establish http connection to localhost for docker"
-        raise
-
-    hdr = {"User-Agent": "test-docker-api.py"}
-    if content:
-        hdr["Content-Type"] = "application/json"
-
-    http_conn.request(method, url, body=content, headers=hdr)
-    response = http_conn.getresponse(buffering=True)
-    data = response.read()
-    if (response.status == 200 or response.status == 201 or
-        response.status == 204):
-        if data:
-            return json.loads(data.decode('utf-8'))
-        else:
-            return ""
-    else:
-        if data:
-            sys.stderr.write(data + "\n")
-        raise IOError('failed to get url ' + url,
-                      " with response code " + str(response.status))
+    return DOCKER_API.get_url(url, method, content)
 
 def usage(message=None):
     """
@@ -1024,10 +3888,25 @@ def usage(message=None):
         sys.stderr.write("\n")
     help_text = """Usage: salt-cluster.py --miniontags string --mastertag string
                           [--master string] [--prefix string]
-                          [--docker string] [--port num]
+                          [--docker string] [--port num] [--jobs num]
+                          [--ready-timeout secs] [--backend string]
+                          [--statedir path] [--preseed-master]
+                          [--preseed-minions] [--shared-hosts]
+                          [--dns ip] [--serve-dns ip]
+                          [--retries num] [--summary path]
+                          [--profile path] [--benchmark]
+                          [--bench-function string] [--bench-args string]
+                          [--bench-jobs num] [--bench-rate num]
+                          [--bench-concurrency num] [--bench-timeout secs]
+                          [--telemetry path] [--telemetry-bucket secs]
+                          [--telemetry-duration secs]
+                          [--matrix-mastertags string]
+                          [--matrix-miniontags string]
+                          [--matrix-clusters num]
                           [--create] [--force]
                           [--start] [--configure] [--stop]
-                          [--delete] [--purge] [--version] [--help]
+                          [--delete] [--purge] [--reconcile]
+                          [--version] [--help]
 
 This script starts up a salt master container and a cluster of
 salt minion containers, with all hostnames and ips added to the
@@ -1043,6 +3922,8 @@ Options:
                     version for git repos must be the tag or branch
                     version for debs must be the string such that
                     salt-common_<version>.deb is the package name to be used
+                    if not given, the minion tags saved in the state
+                    directory the last time the cluster was created are used
   --mastertag (-T)  string specifying which base image and running which
                     version of salt should be used for the master,
                     in the following format:
@@ -1056,31 +3937,210 @@ Options:
                     default: 'minion'  (name will be completed by the
                     the instance number followed by the image version, tag
                     and packagetype, i.e. 'minion-25-precise-v0.15.0-git')
-  --docker    (-d)  full path to docker executable
+  --docker    (-d)  full path to docker executable, only used to build
+                    images if the docker api can't be used for that
                     default: '/usr/bin/docker'
   --port      (-p)  port number for pupaas on each instance
                     default: 8001
+  --backend   (-b)  how to configure salt in the containers, one of
+                    'pupaas' (puppet manifests applied via puppet as a
+                    service) or 'exec' (config files copied in and init
+                    scripts run via the docker api; needs docker 1.8+)
+                    default: 'pupaas'
+  --statedir        directory for files kept between runs, such as
+                    generated keys and the saved cluster state (minion
+                    tags, container ids, ips, master key fingerprint and
+                    the last thing done to each minion); configure skips
+                    minions whose ip and master have not changed, and
+                    that have not been restarted, since they were last
+                    configured
+                    default: '%(statedir)s'
+  --preseed-master  generate the salt master keys here and put them
+                    into the master container when creating it; when
+                    configuring, the minions are then set up while
+                    the master is still starting instead of after it
+                    (use this option with both 'create' and 'configure')
+  --preseed-minions generate keys here for each minion container that
+                    is created, put them into the minion and put the
+                    public keys into the master as accepted keys, so
+                    that minions don't all do their key exchange with
+                    the master at once when the cluster starts
+  --shared-hosts    create containers with one hosts file, kept in the
+                    state directory, bind mounted as /etc/hosts in all
+                    of them; configuring then writes that file once
+                    instead of updating each container's hosts file
+  --dns             create containers with this ip as their nameserver,
+                    which should be where '--serve-dns' runs (usually
+                    the docker bridge address, e.g. 172.17.0.1); their
+                    hosts files are then left alone when configuring
+  --serve-dns       run a dns resolver on this ip, answering for all
+                    container names and hostnames with their current
+                    ips and passing other queries to the host's
+                    nameserver, until interrupted; all other options
+                    are ignored
+  --ready-timeout   how long to wait for pupaas, the salt master and
+                    its key to become available when configuring
+                    default: %(ready_timeout)d seconds
+  --retries         how many times to retry instances that fail in a
+                    phase, waiting a little longer each time
+                    default: %(retries)d
+  --summary         write a json summary of each phase (instances done,
+                    retried and failed, with the errors) to this file,
+                    or to stdout if '-'; either way the script exits
+                    with status 1 if any instances failed
+  --profile         time docker api and pupaas calls, hosts file writes,
+                    builds, each phase and each instance, write them as
+                    json to this file (histograms and percentiles per
+                    type of call, the slowest instances) and print a
+                    summary to stderr at the end
   --create    (-c)  create instances
   --force     (-f)  create containers / images even if they already exist
-                    this option can only be used with 'create'
+                    this option can only be used with 'create'; without it,
+                    existing images are rebuilt only if their dockerfile,
+                    base image or salt git commit has changed
   --start     (-s)  start instances
   --configure (-C)  configure running instances
   --stop      (-S)  stop running instances
   --delete    (-D)  delete instances, implies 'stop'
   --purge     (-p)  purge images, implies 'stop' and 'delete'
-  --instance  (-i)  specific instance number in case you want to
-                    stop/start/configure/delete only one
+  --reconcile       make the running cluster match the minion tags:
+                    delete minions that are no longer wanted (or whose
+                    tag changed), create, start and configure the ones
+                    that are missing or stopped, and leave the rest
+                    alone; done after any of the above
+  --benchmark       load test the salt master of the (configured) cluster:
+                    send it salt jobs for all the minions at a steady rate
+                    and report how long the returns took (50th, 95th and
+                    99th percentile), the returns that never came and
+                    jobs per second; done after any of the above
+  --bench-function  the salt function the benchmark runs
+                    default: 'test.ping'
+  --bench-args      comma separated arguments for the function,
+                    e.g. 'uptime' for cmd.run
+  --bench-jobs      how many jobs the benchmark sends
+                    default: 10
+  --bench-rate      how many jobs to send per second
+                    default: 1
+  --bench-concurrency  most jobs waiting for returns at once
+                    default: 1
+  --bench-timeout   seconds to wait for the returns for a job
+                    default: 30
+  --telemetry       watch the salt master event bus while configuring,
+                    benchmarking etc. (after create and start) and write
+                    auths, job publishes and returns per second, returns
+                    outstanding and return latency for each minion tag,
+                    per interval of time, to this file as json lines; if
+                    there is nothing else to do, watch until the duration
+                    is up
+  --telemetry-bucket  seconds per interval
+                    default: %(telemetry_bucket)d
+  --telemetry-duration  seconds to watch for at most
+                    default: %(telemetry_duration)d
+  --matrix-mastertags  comma separated list of master tags (as for
+                    --mastertag) for a version matrix run: for each of
+                    these and each --matrix-miniontags, a cluster is
+                    created, started, configured, load tested (see
+                    --benchmark, whose options apply) and then stopped
+                    and deleted, and a table comparing them is printed;
+                    each cluster's names get '-<number>' added to the
+                    --master and --minion base names so they can run
+                    side by side; with --summary, the results for each
+                    cluster are written there
+  --matrix-miniontags  minion tags (as for --miniontags) for a version
+                    matrix run; may be given more than once
+  --matrix-clusters  how many clusters of the matrix to run at once,
+                    or 'auto' to go by the size of the biggest cluster
+                    and the host's resources; with '--jobs auto' the
+                    clusters running at once share what the host has
+                    room for, rather than each taking all of it
+                    default: 'auto'
+  --instance  (-i)  instances to create/start/configure/stop/delete
+                    instead of all of them: a comma separated list of
+                    instance numbers, ranges of them, and minion tags
+                    <image>:<saltvers>:<ptype> (any field may be '*')
+                    for all the minions of that tag
+                    example: 5-40,77,trusty:*:deb
+  --jobs      (-j)  number of minions to create/start/configure/stop/delete
+                    at once, or 'auto' to pick this from the number of
+                    processors, load average and free memory of the host
+                    default: 1 (docker has not always coped well with
+                    concurrent configures and stops)
   --verbose   (-V)  show progress messages as the script runs
   --version   (-v)  print version information and exit
   --help      (-h)  display this usage message
 
-If multiple of 'create', 'start', configure', 'stop', 'delete', 'purge'
-are specified, each specified option will be done on the cluster in the
-above order.
-"""
+If multiple of 'create', 'start', configure', 'stop', 'delete', 'purge',
+'reconcile' are specified, each specified option will be done on the
+cluster in the above order.
+""" % {'ready_timeout': READY_TIMEOUT, 'statedir': STATE_DIR,
+       'retries': RETRIES, 'telemetry_bucket': TELEMETRY_BUCKET,
+       'telemetry_duration': TELEMETRY_DURATION}
     sys.stderr.write(help_text)
     sys.exit(1)
 
+def write_summary(summary, path):
+    'write the phase summary as json to the file, or stdout for "-"'
+    contents = json.dumps({'phases': summary,
+                           'failed': sum(len(phase['failed'])
+                                         for phase in summary)},
+                          indent=1, sort_keys=True) + "\n"
+    if path == '-':
+        sys.stdout.write(contents)
+    else:
+        with open(path, 'w') as summary_file:
+            summary_file.write(contents)
+
+def get_matrix_table(results):
+    """
+    return a table comparing the clusters run by
+    VersionMatrix, one line for each
+    """
+    headers = ['master', 'minions', 'status', 'failed', 'create',
+               'configure', 'jobs/s', 'returns/s', 'p50', 'p95', 'p99',
+               'missing']
+    rows = []
+    for result in results:
+        report = result['benchmark'] or {}
+        row = [result['master'], result['minions'], result['status'],
+               str(result['failed'])]
+        for step in ['create', 'configure']:
+            row.append("%.1fs" % result['times'][step]
+                       if step in result['times'] else '-')
+        for name, fmt in [('jobs_per_second', "%.2f"),
+                          ('returns_per_second', "%.2f"), ('p50', "%.3fs"),
+                          ('p95', "%.3fs"), ('p99', "%.3fs"),
+                          ('missing_returns', "%d")]:
+            row.append(fmt % report[name] if name in report else '-')
+        rows.append(row)
+    widths = [max(len(row[col]) for row in [headers] + rows)
+              for col in range(len(headers))]
+    lines = ["  ".join(field.ljust(width) for field, width
+                       in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    errors = ["%s with %s: %s" % (result['master'], result['minions'],
+                                  result['error'])
+              for result in results if result['error']]
+    return "\n".join(lines + errors) + "\n"
+
+def write_matrix_summary(results, path):
+    'write the VersionMatrix results as json to the file, or stdout for "-"'
+    contents = json.dumps({'matrix': results,
+                           'failed': sum(1 for result in results
+                                         if result['status'] != 'ok')},
+                          indent=1, sort_keys=True) + "\n"
+    if path == '-':
+        sys.stdout.write(contents)
+    else:
+        with open(path, 'w') as summary_file:
+            summary_file.write(contents)
+
+def write_profile(path):
+    'write the --profile report as json to the file, summary to stderr'
+    report = PROFILER.get_report()
+    with open(path, 'w') as profile_file:
+        profile_file.write(json.dumps(report, indent=1, sort_keys=True) + "\n")
+    sys.stderr.write(PROFILER.get_summary(report))
+
 def show_version():
     'show the version of this script'
     print "salt-cluster.py " + VERSION
@@ -1099,6 +4159,25 @@ def handle_action(cluster, instance, actions, verbose):
         if verbose:
             print "Starting cluster..."
         cluster.start_cluster(instance)
+    telemetry = actions['telemetry']
+    if telemetry:
+        cluster.start_telemetry(telemetry['bucket'], telemetry['duration'])
+    try:
+        handle_later_actions(cluster, instance, actions, verbose)
+    finally:
+        if telemetry:
+            # with nothing else to do, watch for the whole duration
+            others = [name for name in ['configure', 'stop', 'delete',
+                                        'purge', 'reconcile']
+                      if actions[name]]
+            cluster.stop_telemetry(telemetry['path'], wait=not others and
+                                   actions['benchmark'] is None)
+
+def handle_later_actions(cluster, instance, actions, verbose):
+    """
+    execute the actions after create and start that are
+    marked as true, in the proper order
+    """
     if actions['configure']:
         if verbose:
             print "Configuring cluster..."
@@ -1115,9 +4194,18 @@ def handle_action(cluster, instance, actions, verbose):
         if verbose:
             print "Purging cluster..."
         cluster.purge_cluster(instance)
+    if actions['reconcile']:
+        if verbose:
+            print "Reconciling cluster..."
+        cluster.reconcile_cluster()
+    if actions['benchmark'] is not None:
+        if verbose:
+            print "Benchmarking cluster..."
+        cluster.benchmark_cluster(actions['benchmark'])
 
 def main():
     'main entry point, does all the work'
+    set_thread_stack_size()
     saltmaster_prefix = 'master'
     saltminion_prefix = 'minion'
     pupaas_port = 8010
@@ -1131,17 +4219,43 @@ def main():
     stop = False
     delete = False
     purge = False
+    reconcile = False
+    retries = RETRIES
+    summary = None
+    profile = None
+    benchmark = None
+    telemetry = None
+    matrix_mastertags = None
+    matrix_miniontags = []
+    matrix_clusters = 'auto'
     verbose = False
     instance = None
+    concurrency = 1
+    ready_timeout = READY_TIMEOUT
+    backend = 'pupaas'
+    state_dir = STATE_DIR
+    preseed_master = False
+    preseed_minions = False
+    shared_hosts = False
+    dns = None
+    serve_dns = None
 
     try:
         (options, remainder) = getopt.gnu_getopt(
-            sys.argv[1:], "M:m:d:p:P:t:T:i:CfsSDVvh",
+            sys.argv[1:], "M:m:d:p:P:t:T:i:j:b:CfsSDVvh",
             ["master=", "mastertag=", "minion=", "docker=",
              "port=", "miniontags=", "matertag=",
-             "instance=", "create",
+             "instance=", "jobs=", "ready-timeout=", "backend=",
+             "statedir=", "preseed-master", "preseed-minions",
+             "shared-hosts", "dns=", "serve-dns=", "retries=",
+             "summary=", "profile=", "benchmark", "bench-function=",
+             "bench-args=", "bench-jobs=", "bench-rate=",
+             "bench-concurrency=", "bench-timeout=", "telemetry=",
+             "telemetry-bucket=", "telemetry-duration=",
+             "matrix-mastertags=", "matrix-miniontags=",
+             "matrix-clusters=", "create",
              "force", "start", "configure", "stop",
-             "delete", "purge",
+             "delete", "purge", "reconcile",
              "verbose", "version", "help"])
 
     except getopt.GetoptError as err:
@@ -1154,9 +4268,35 @@ def main():
         elif opt in ["-d", "--docker"]:
             docker = val
         elif opt in ["-i", "--instance"]:
+            instance = val
+        elif opt in ["-j", "--jobs"]:
+            concurrency = get_concurrency_from_text(val)
+            if concurrency is None:
+                usage("jobs must be a positive number or 'auto'")
+        elif opt in ["-b", "--backend"]:
+            if val not in ['pupaas', 'exec']:
+                usage("backend must be one of 'pupaas' or 'exec'")
+            backend = val
+        elif opt == "--statedir":
+            state_dir = val
+        elif opt == "--preseed-master":
+            preseed_master = True
+        elif opt == "--preseed-minions":
+            preseed_minions = True
+        elif opt == "--shared-hosts":
+            shared_hosts = True
+        elif opt == "--dns":
+            if not is_ip(val):
+                usage("dns must be an ip address")
+            dns = [val]
+        elif opt == "--serve-dns":
+            if not is_ip(val):
+                usage("serve-dns must be an ip address")
+            serve_dns = val
+        elif opt == "--ready-timeout":
             if not val.isdigit():
-                usage("instance must be a number")
-            instance = int(val)
+                usage("ready-timeout must be a number")
+            ready_timeout = int(val)
         elif opt in ["-p", "--port"]:
             if not val.isdigit():
                 usage("port must be a number")
@@ -1182,6 +4322,56 @@ def main():
             stop = True
             delete = True
             purge = True
+        elif opt == "--reconcile":
+            reconcile = True
+        elif opt == "--retries":
+            if not val.isdigit():
+                usage("retries must be a number")
+            retries = int(val)
+        elif opt == "--summary":
+            summary = val
+        elif opt == "--profile":
+            profile = val
+            PROFILER.enabled = True
+        elif opt.startswith("--telemetry"):
+            telemetry = telemetry or {'path': None,
+                                      'bucket': TELEMETRY_BUCKET,
+                                      'duration': TELEMETRY_DURATION}
+            if opt == "--telemetry":
+                telemetry['path'] = val
+            else:
+                name = opt[len("--telemetry-"):]
+                if not val.isdigit() or not int(val):
+                    usage("telemetry-%s must be a positive number" % name)
+                telemetry[name] = int(val)
+        elif opt == "--matrix-mastertags":
+            matrix_mastertags = val.split(",")
+        elif opt == "--matrix-miniontags":
+            matrix_miniontags.append(val)
+        elif opt == "--matrix-clusters":
+            matrix_clusters = get_concurrency_from_text(val)
+            if matrix_clusters is None:
+                usage("matrix-clusters must be a positive number or 'auto'")
+        elif opt == "--benchmark":
+            benchmark = benchmark or {}
+        elif opt.startswith("--bench-"):
+            benchmark = benchmark or {}
+            name = opt[len("--bench-"):]
+            if name == "function":
+                benchmark['function'] = val
+            elif name == "args":
+                benchmark['args'] = val.split(',') if val else []
+            elif name == "rate":
+                try:
+                    benchmark['rate'] = float(val)
+                except ValueError:
+                    usage("bench-rate must be a number")
+                if benchmark['rate'] <= 0:
+                    usage("bench-rate must be more than 0")
+            else:
+                if not val.isdigit() or not int(val):
+                    usage("bench-%s must be a positive number" % name)
+                benchmark[name] = int(val)
         elif opt in ["-V", "--verbose"]:
             verbose = True
         elif opt in ["-v", "--version"]:
@@ -1194,18 +4384,77 @@ def main():
     if len(remainder) > 0:
         usage("Unknown option(s) specified: <%s>" % remainder[0])
 
-    if not miniontags:
-        usage("The mandatory option 'miniontags' was not specified.\n")
+    if serve_dns:
+        try:
+            ClusterResolver(serve_dns).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if matrix_mastertags or matrix_miniontags:
+        if not matrix_mastertags or not matrix_miniontags:
+            usage("matrix-mastertags and matrix-miniontags go together")
+        for tag_text in (["1:" + tag for tag in matrix_mastertags] +
+                         ",".join(matrix_miniontags).split(",")):
+            if len(tag_text.split(':')) != 4:
+                usage("bad tag for version matrix: %s" % tag_text)
+
+        def make_cluster(number, master_tag, minion_tags, jobs):
+            'make the cluster for one combination of the matrix'
+            return SaltCluster("%s-%d" % (saltmaster_prefix, number),
+                               "%s-%d" % (saltminion_prefix, number),
+                               pupaas_port, docker, minion_tags, master_tag,
+                               True, force, verbose, jobs,
+                               ready_timeout, backend, state_dir,
+                               preseed_master, preseed_minions,
+                               shared_hosts, dns, retries)
+        matrix = VersionMatrix(matrix_mastertags, matrix_miniontags,
+                               make_cluster, benchmark or {},
+                               matrix_clusters, concurrency, verbose)
+        try:
+            results = matrix.run()
+        finally:
+            if profile:
+                write_profile(profile)
+        sys.stdout.write(get_matrix_table(results))
+        if summary:
+            write_matrix_summary(results, summary)
+        if any(result['status'] != 'ok' for result in results):
+            sys.exit(1)
+        sys.exit(0)
+
     if not mastertag:
         usage("The mandatory option 'mastertag' was not specified.\n")
+    if telemetry and not telemetry['path']:
+        usage("telemetry-bucket and telemetry-duration need --telemetry")
 
     cluster = SaltCluster(saltmaster_prefix, saltminion_prefix, pupaas_port,
                     docker, miniontags, mastertag, create,
-                    force, verbose)
+                    force, verbose, concurrency, ready_timeout, backend,
+                    state_dir, preseed_master, preseed_minions,
+                    shared_hosts, dns, retries)
+    if not cluster.minion_tags:
+        usage("The mandatory option 'miniontags' was not specified "
+              "and there is no saved state for this cluster.\n")
+    if instance is not None:
+        try:
+            instance = cluster.select_instances(instance)
+        except ValueError as err:
+            usage("bad instance selection: %s" % err)
     actions = {'create': create, 'start': start,
                'configure': configure, 'stop': stop,
-               'delete': delete, 'purge': purge}
-    handle_action(cluster, instance, actions, verbose)
+               'delete': delete, 'purge': purge, 'reconcile': reconcile,
+               'benchmark': benchmark, 'telemetry': telemetry}
+    try:
+        handle_action(cluster, instance, actions, verbose)
+    finally:
+        # a phase that raised is just when the summary is wanted
+        if profile:
+            write_profile(profile)
+        if summary:
+            write_summary(cluster.summary, summary)
+    if any(phase['failed'] for phase in cluster.summary):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
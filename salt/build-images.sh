@@ -1,11 +1,38 @@
 #!/bin/bash
 
-python generate_dockerfile.py -d precise > Dockerfile
-docker build --rm -t ariel/salt:precisebase .
+# the base images don't depend on each other, so build
+# them all at once, each from its own dockerfile;
+# the output of each build goes to build-<distro>.log
+#
+# an image whose hash label matches what we would build
+# now is up to date and is left alone
 
-python generate_dockerfile.py -d trusty > Dockerfile
-docker build --rm -t ariel/salt:trustybase .
+build_base() {
+    distro="$1"
+    wanted=$(python generate_dockerfile.py -d "$distro" --hash) || return 1
+    have=$(docker inspect -f '{{ index .Config.Labels "saltcluster.hash" }}' "ariel/salt:${distro}base" 2>/dev/null)
+    if [ "$wanted" == "$have" ]; then
+        echo "ariel/salt:${distro}base is up to date"
+        return 0
+    fi
+    python generate_dockerfile.py -d "$distro" > "Dockerfile.$distro" || return 1
+    docker build --rm -t "ariel/salt:${distro}base" -f "Dockerfile.$distro" . > "build-$distro.log" 2>&1
+}
 
-python generate_dockerfile.py -d jessie > Dockerfile
-docker build --rm -t ariel/salt:jessiebase .
+distros="precise trusty jessie"
+pids=""
+for distro in $distros; do
+    build_base "$distro" &
+    pids="$pids $!"
+done
 
+status=0
+set -- $distros
+for pid in $pids; do
+    if ! wait "$pid"; then
+        echo "Failed to build base image for $1, see build-$1.log" >&2
+        status=1
+    fi
+    shift
+done
+exit $status
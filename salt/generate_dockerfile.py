@@ -1,11 +1,16 @@
 import sys
 import getopt
+import hashlib
 
 VERSION = "0.1"
 
 DEPS_PATH = '/root/depends/'
 SALT_PATH = '/root/salt/'
 
+# images are labelled with a hash of everything that went
+# into them, so we can tell when they need rebuilding
+HASH_LABEL = 'saltcluster.hash'
+
 def get_dep_entries(packages):
     """
     given list of packages that are salt dependencies,
@@ -35,10 +40,38 @@ def get_salt_deb_entries(package_versions):
         text = text + "\n"
     return text
 
+def get_build_hash(dockerfile_contents):
+    """
+    return a hash of the dockerfile contents and
+    of every local file that it ADDs to the image
+    """
+    build_hash = hashlib.sha1(dockerfile_contents)
+    for line in dockerfile_contents.splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0] != 'ADD':
+            continue
+        for path in fields[1:-1]:
+            build_hash.update(path)
+            with open(path, 'rb') as added:
+                while True:
+                    data = added.read(1024 * 1024)
+                    if not data:
+                        break
+                    build_hash.update(data)
+    return build_hash.hexdigest()
+
+def add_hash_label(dockerfile_contents):
+    """
+    append a label with the build hash of the dockerfile
+    contents to the end of them, and return the result
+    """
+    return dockerfile_contents + "\nLABEL {label}={value}\n".format(
+        label=HASH_LABEL, value=get_build_hash(dockerfile_contents))
+
 def generate(distro):
     """
     read Dockerfile.tmpl, stuff in appropriate values
-    depending on the distro, write result to stdout
+    depending on the distro, return the result
     """
     if distro == 'precise':
         os_text = 'ubuntu'
@@ -146,7 +179,7 @@ def generate(distro):
         ruby=ruby,
         ssldeps=ssldeps
         )
-    print dockerfile_contents
+    return dockerfile_contents
 
 def show_version():
     'show the version of this script'
@@ -162,17 +195,23 @@ def usage(message=None):
         sys.stderr.write(message)
         sys.stderr.write("\n")
     help_text = """Usage: generate_dockerfile.py --distro <text>
-                          [--version] [--help]
+                          [--hash] [--version] [--help]
 
 This script generates a dockerfile which can be used to build
 a base image for the specified ubuntu version, to be used to
 create a salt cluster of docker containers.
 
+The dockerfile ends with a label holding a hash of its contents
+and of all the files it adds to the image; an image with the
+same label does not need to be rebuilt.
+
 Options:
 
   --distro  (-d)  string specifying ubuntu/debian version, one of
                   'precise', 'trusty' or 'jessie'
 
+  --hash    (-H)  write only the hash that would go in the label
+
   --version (-v)  display the version of this script and exit
 
   --help    (-h)  show this help message
@@ -182,17 +221,20 @@ Options:
 
 def main():
     distro = None
+    hash_only = False
 
     try:
         (options, remainder) = getopt.gnu_getopt(
-            sys.argv[1:], "d:vh",
-            ["distro=", "version", "help"])
+            sys.argv[1:], "d:Hvh",
+            ["distro=", "hash", "version", "help"])
 
     except getopt.GetoptError as err:
         usage("Unknown option specified: " + str(err))
     for (opt, val) in options:
         if opt in ["-d", "--distro"]:
             distro = val
+        elif opt in ["-H", "--hash"]:
+            hash_only = True
         elif opt in ["-v", "--version"]:
             show_version()
         elif opt in ["-h", "--help"]:
@@ -209,7 +251,15 @@ def main():
     if distro not in ['precise', 'trusty', 'jessie']:
         usage("Unknown distro specified")
 
-    generate(distro)
+    dockerfile_contents = generate(distro)
+    try:
+        if hash_only:
+            print get_build_hash(dockerfile_contents)
+        else:
+            print add_hash_label(dockerfile_contents)
+    except IOError as err:
+        sys.stderr.write("Failed to read file added by dockerfile: %s\n" % err)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Run on a salt master: listen on the master event bus and
+print one compact json line per event we care about, as
+
+{"t": time, "type": "auth"|"new"|"ret", "id": minion or null,
+ "jid": jid or null, "minions": count (for "new" only)}
+
+until 'duration' seconds (the first argument) have passed
+or whoever reads our output goes away. If the master isn't
+running yet, we wait for its event bus to appear. salt-cluster.py
+copies this in and runs it for --telemetry.
+"""
+
+import os
+import sys
+import json
+import time
+
+import salt.utils.event
+
+SOCK_DIR = "/var/run/salt/master"
+
+
+def get_record(tag, data):
+    """
+    turn an event into the record we print, or None if
+    it's not an auth, a job publish or a job return;
+    newer salt tags job events salt/job/<jid>/new and
+    salt/job/<jid>/ret/<id>, older salt uses new_job and
+    the bare jid, and 2014.x fires both for each, so
+    salt-cluster.py drops the repeats
+    """
+    if tag in ['salt/auth', 'auth']:
+        return {'type': 'auth', 'id': data.get('id'), 'jid': None}
+    parts = tag.split('/')
+    if tag.startswith('salt/job/'):
+        if len(parts) == 4 and parts[3] == 'new':
+            return {'type': 'new', 'id': None, 'jid': parts[2],
+                    'minions': len(data.get('minions') or [])}
+        if len(parts) == 5 and parts[3] == 'ret':
+            return {'type': 'ret', 'id': parts[4], 'jid': parts[2]}
+        return None
+    if tag == 'new_job' and 'jid' in data and 'minions' in data:
+        return {'type': 'new', 'id': None, 'jid': data['jid'],
+                'minions': len(data['minions'])}
+    if tag == data.get('jid') and 'return' in data and 'id' in data:
+        return {'type': 'ret', 'id': data['id'], 'jid': data['jid']}
+    return None
+
+
+def main():
+    'main entry point, does all the work'
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    deadline = time.time() + duration
+    while not os.path.exists(os.path.join(SOCK_DIR,
+                                          'master_event_pub.ipc')):
+        if time.time() > deadline:
+            return
+        time.sleep(0.5)
+    event = salt.utils.event.MasterEvent(SOCK_DIR)
+    while time.time() < deadline:
+        ret = event.get_event(wait=1, full=True)
+        if not ret:
+            continue
+        data = ret.get('data') or {}
+        record = get_record(ret.get('tag') or '', data)
+        if record is None:
+            continue
+        record['t'] = time.time()
+        try:
+            sys.stdout.write(json.dumps(record, separators=(',', ':')) + "\n")
+            sys.stdout.flush()
+        except IOError:
+            # nobody is listening any more
+            return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Run on a salt master: send salt jobs to the minions at a
+given rate, with at most so many in flight at once, and
+note how long after each job was sent each minion's return
+came in. The parameters are passed as one json argument:
+
+{"target": "*", "function": "test.ping", "args": [],
+ "jobs": 10, "rate": 1.0, "concurrency": 1, "timeout": 30}
+
+and the results are printed as json on the last line:
+
+{"elapsed": secs, "jobs": [{"job": n, "sent": secs since
+ start, "returns": {minion: secs}, "error": text or null}]}
+
+salt-cluster.py copies this in and runs it for --benchmark.
+"""
+
+import sys
+import json
+import time
+import threading
+
+import salt.client
+
+
+def run_job(params, number, start, results, lock):
+    'send one job and collect the returns as they arrive'
+    sent = time.time()
+    returns = {}
+    error = None
+    try:
+        client = salt.client.LocalClient()
+        for ret in client.cmd_iter(params['target'], params['function'],
+                                   params['args'],
+                                   timeout=params['timeout']):
+            now = time.time()
+            for minion in ret:
+                returns[minion] = now - sent
+    except Exception as ex:
+        error = "%s: %s" % (ex.__class__.__name__, ex)
+    with lock:
+        results.append({'job': number, 'sent': sent - start,
+                        'returns': returns, 'error': error})
+
+
+def main():
+    'main entry point, does all the work'
+    params = json.loads(sys.argv[1])
+    results = []
+    lock = threading.Lock()
+    in_flight = threading.Semaphore(params['concurrency'])
+    threads = []
+
+    def do_job(number):
+        'run a job and let the next one go'
+        try:
+            run_job(params, number, start, results, lock)
+        finally:
+            in_flight.release()
+
+    start = time.time()
+    for number in range(params['jobs']):
+        due = start + number / float(params['rate'])
+        if due > time.time():
+            time.sleep(due - time.time())
+        in_flight.acquire()
+        thr = threading.Thread(target=do_job, args=(number,))
+        thr.daemon = True
+        thr.start()
+        threads.append(thr)
+    for thr in threads:
+        thr.join()
+    results.sort(key=lambda result: result['job'])
+    print json.dumps({'elapsed': time.time() - start, 'jobs': results})
+
+if __name__ == '__main__':
+    main()
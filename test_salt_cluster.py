@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for salt-cluster.py; the cluster tests run it against
+the fake docker daemon and fake pupaas server from
+salt-cluster-benchmark.py. Run with:
+python -m unittest test_salt_cluster
+"""
+
+import os
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+
+BENCHMARK = imp.load_source(
+    'salt_cluster_benchmark',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "salt-cluster-benchmark.py"))
+SALT_CLUSTER = BENCHMARK.load_salt_cluster()
+
+
+class FakeResponse(object):
+    'an http response handing back its body as asked for'
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, size):
+        'return the next size bytes of the body'
+        data = self.body[:size]
+        self.body = self.body[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class TestReadJsonMessages(unittest.TestCase):
+    'decoding the streamed output of docker builds'
+
+    def test_character_split_across_chunks(self):
+        'a multi-byte character split between two reads is decoded whole'
+        line = u"Step 1 : RUN echo café ☃"
+        first = json.dumps({"stream": "x" * 50})
+        # put the snowman's three bytes across the first read boundary
+        padding = SALT_CLUSTER.STREAM_READ_SIZE - len(first) - 40
+        message = json.dumps({"stream": "y" * padding + line},
+                             ensure_ascii=False).encode('utf-8')
+        body = first + "\r\n" + message + "\r\n"
+        split = body.index(u"☃".encode('utf-8'))
+        self.assertTrue(split < SALT_CLUSTER.STREAM_READ_SIZE <= split + 2)
+        messages = list(SALT_CLUSTER.read_json_messages(
+            SALT_CLUSTER.read_chunks(FakeResponse(body))))
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[1]["stream"].endswith(line))
+
+    def test_one_byte_chunks(self):
+        'messages come out the same however the stream is cut up'
+        body = json.dumps({"stream": u"über"},
+                          ensure_ascii=False).encode('utf-8') * 3
+        messages = list(SALT_CLUSTER.read_json_messages(
+            [body[i] for i in range(len(body))]))
+        self.assertEqual(messages, [{"stream": u"über"}] * 3)
+
+
+class TestReconcile(unittest.TestCase):
+    'changing the size of a cluster against the fake servers'
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="test-salt-cluster-")
+        hosts_dir = os.path.join(self.work_dir, "hosts")
+        os.mkdir(hosts_dir)
+        socket_name = os.path.join(self.work_dir, "docker.sock")
+        self.docker = BENCHMARK.FakeDocker(SALT_CLUSTER, hosts_dir)
+        self.servers = [BENCHMARK.UnixHTTPServer(
+            socket_name, BENCHMARK.FakeDockerHandler, self.docker)]
+        self.pupaas = BENCHMARK.FakePupaas()
+        self.servers.append(BENCHMARK.TCPHTTPServer(
+            BENCHMARK.FakePupaasHandler, self.pupaas))
+        for server in self.servers:
+            BENCHMARK.start_server(server)
+        SALT_CLUSTER.DOCKER_API.socket_name = socket_name
+        SALT_CLUSTER.SALT_MASTER_PORT = BENCHMARK.start_master_port()
+        self.clusters = []
+
+    def tearDown(self):
+        for cluster in self.clusters:
+            cluster.backend.puppet.close()
+        SALT_CLUSTER.DOCKER_API.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def get_cluster(self, minions):
+        'return a cluster of the given number of minions, sharing state'
+        cluster = SALT_CLUSTER.SaltCluster(
+            'master', 'minion', self.servers[1].server_address[1],
+            '/usr/bin/docker', "%d:%s" % (minions, BENCHMARK.MINION_TAG),
+            BENCHMARK.MINION_TAG, True, False, False, 4,
+            state_dir=os.path.join(self.work_dir, "state"), retries=0)
+        # no images here, the fake daemon only does containers
+        cluster.add_image_build = lambda graph, tag, role: None
+        self.clusters.append(cluster)
+        return cluster
+
+    def test_grow_leaves_master_alone(self):
+        'adding minions configures them but not the running master'
+        cluster = self.get_cluster(3)
+        for phase in ['create', 'start', 'configure']:
+            self.assertEqual(getattr(cluster, phase + '_cluster')(), [])
+        master_ip = cluster.master.ip_addr
+
+        self.pupaas.reset_calls()
+        self.assertEqual(self.get_cluster(5).reconcile_cluster(), [])
+        self.assertEqual(self.pupaas.calls_by_address.get(master_ip), None)
+        configured = [address for address in self.pupaas.calls_by_address
+                      if self.pupaas.calls_by_address[address]['POST /apply']]
+        self.assertEqual(len(configured), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()